@@ -0,0 +1,86 @@
+"""
+Microbenchmarks for Djax.  Run with "manage.py djax_benchmark".
+"""
+import timeit
+
+def _per_call(func,calls,number=10,repeat=3):
+    """
+    Times func, which makes the specified number of calls each run.  Returns the
+    best time per call in microseconds.
+    """
+    best = min(timeit.repeat(func,number=number,repeat=repeat))
+    return best / (number * calls) * 1000000
+
+def trigger_dispatch(counts=(10,100,1000)):
+    """
+    Measures the per-request cost of matching a request path against the trigger
+    mappings, with a linear scan of the mappings and with the compiled dispatcher.
+    Returns a list of (trigger count, linear scan us, dispatcher us) tuples.
+    """
+    from djax.triggers import Trigger, TriggerDispatcher
+    
+    results = []
+    for count in counts:
+        trigger_list = [Trigger(r'^section-%d/(?P<slug>[\w-]+)/$' % i,'pageview','section-%d' % i,slug='$slug') for i in range(count)]
+        trigger_list.append(Trigger(r'^$','pageview','home'))
+        dispatcher = TriggerDispatcher(trigger_list)
+        
+        # half of the paths match a trigger, half do not
+        paths = ['section-%d/an-article/' % (i * count / 50) for i in range(100)]
+        
+        def linear():
+            for path in paths:
+                [trigger for trigger in trigger_list if trigger.regex.match(path)]
+        
+        def compiled():
+            for path in paths:
+                dispatcher.match(path)
+        
+        results.append((count,_per_call(linear,len(paths)),_per_call(compiled,len(paths))))
+    
+    return results
+
+def field_map_apply(counts=(5,20,50)):
+    """
+    Measures the per-item cost of applying a field map to a local model, walking the
+    field map for each item and with a compiled field map plan.  Half of the fields
+    use field converters, one in five of which is nullable.  Returns a list of (field
+    count, field map walk us, plan us) tuples.
+    """
+    from djax.content import FieldMapPlan, DefaultFieldConverter, WriteNullFieldConverter
+    from pax.content import ContentImage
+    
+    class LocalModel(object):
+        pass
+    
+    results = []
+    for count in counts:
+        field_map = {}
+        for i in range(count):
+            if i % 2:
+                field_map['field%d' % i] = 'field%d' % i
+            elif i % 5:
+                field_map['field%d' % i] = DefaultFieldConverter('field%d' % i)
+            else:
+                field_map['field%d' % i] = WriteNullFieldConverter('field%d' % i)
+        
+        items = [ContentImage({'content_type':'Article','key':'%x' % n,'data':dict(('field%d' % i,'value %d' % n) for i in range(count))}) for n in range(100)]
+        local_model = LocalModel()
+        plan = FieldMapPlan(field_map)
+        
+        def walk():
+            for item in items:
+                FieldMapPlan(field_map).apply(item,local_model)
+        
+        def planned():
+            for item in items:
+                plan.apply(item,local_model)
+        
+        results.append((count,_per_call(walk,len(items)),_per_call(planned,len(items))))
+    
+    return results
+
+benchmarks = {
+    'triggers':(trigger_dispatch,('triggers','linear us/request','dispatcher us/request')),
+    'fieldmaps':(field_map_apply,('fields','walk us/item','plan us/item')),
+}
@@ -0,0 +1,270 @@
+"""
+Caching for Djax.
+"""
+from django.conf import settings
+from collections import OrderedDict, namedtuple
+from djax.registry import get_module
+import hashlib
+import logging
+import threading
+import time
+
+log = logging.getLogger('djax')
+
+ChannelRanking = namedtuple('ChannelRanking',['content_type','key','endorsement'])
+
+# ===================
+# = Cache Backends =
+# ===================
+class LocMemCache(object):
+    """
+    In-process LRU cache backend.  Holds at most max_entries entries.
+    """
+    def __init__(self,max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        """
+        Gets the cached value, or None.
+        """
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self.entries[key] = (value,expires) # most recently used goes to the end
+            return value
+
+    def set(self,key,value,timeout):
+        """
+        Caches the value for timeout seconds.
+        """
+        with self.lock:
+            self._set(key,value,timeout)
+
+    def add(self,key,value,timeout):
+        """
+        Caches the value only if the key is not already cached.  Returns True if the
+        value was added.
+        """
+        with self.lock:
+            if key in self.entries and self.entries[key][1] >= time.time():
+                return False
+            self._set(key,value,timeout)
+            return True
+
+    def _set(self,key,value,timeout):
+        # callers hold the lock
+        self.entries.pop(key,None)
+        self.entries[key] = (value,time.time() + timeout)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete(self,key):
+        """
+        Removes the key from the cache.
+        """
+        with self.lock:
+            self.entries.pop(key,None)
+
+class DjangoCache(object):
+    """
+    Cache backend using one of the Django caches, so that cached values are shared
+    across processes.
+    """
+    def __init__(self,alias='default'):
+        try:
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+
+    def get(self,key):
+        return self.cache.get(key)
+
+    def set(self,key,value,timeout):
+        self.cache.set(key,value,timeout)
+
+    def add(self,key,value,timeout):
+        return self.cache.add(key,value,timeout)
+
+    def delete(self,key):
+        self.cache.delete(key)
+
+# backend names used by the channel cache settings
+LocMemChannelCache = LocMemCache
+DjangoChannelCache = DjangoCache
+
+def build_backend(path,options):
+    """
+    Builds the cache backend with the dotted class path.
+    """
+    module_name, class_name = path.rsplit('.',1)
+    backend_class = getattr(get_module(module_name),class_name)
+    return backend_class(**options)
+
+# =================
+# = Channel Cache =
+# =================
+class ChannelCache(object):
+    """
+    Caches content channel rankings, keyed by channel, profile, basekey, flavor and limit.
+
+    Rankings younger than the channel's TTL are served from the cache.  Rankings older
+    than the TTL but still within the stale window are also served from the cache, while
+    a single background refresh fetches new rankings from ACE.
+    """
+    def __init__(self,backend,ttl=60,stale=0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale = stale
+
+    def channel_ttl(self,channel):
+        """
+        Gets the TTL for the channel.  The TTL may be set per channel with a dictionary
+        of channel slug to seconds, with the 'default' key used for other channels.
+        """
+        if hasattr(self.ttl,'keys'):
+            return self.ttl.get(channel,self.ttl.get('default',60))
+        return self.ttl
+
+    def cache_key(self,channel,profile=None,basekey=None,flavor=None,limit=None):
+        """
+        Builds the cache key for the channel call.
+        """
+        return 'djax-channel:%s' % hashlib.md5(repr((channel,profile,basekey,flavor,limit))).hexdigest()
+
+    def channel(self,client,channel,profile=None,basekey=None,flavor=None,limit=None):
+        """
+        Gets the rankings for the channel, as a list of ChannelRankings.
+        """
+        key = self.cache_key(channel,profile,basekey,flavor,limit)
+        entry = self.backend.get(key)
+        if entry:
+            rankings, fetched = entry
+            age = time.time() - fetched
+            ttl = self.channel_ttl(channel)
+            if age < ttl:
+                return rankings
+            if age < ttl + self.stale:
+                self.refresh(client,key,channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
+                return rankings
+
+        return self.fetch(client,key,channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
+
+    def fetch(self,client,key,channel,**params):
+        """
+        Fetches the rankings from ACE and caches them.
+        """
+        results = client.channel(channel,**params)
+        rankings = [ChannelRanking(item.content_type,item.key,item.endorsement) for item in results.items]
+        self.backend.set(key,(rankings,time.time()),self.channel_ttl(channel) + self.stale)
+        return rankings
+
+    def refresh(self,client,key,channel,**params):
+        """
+        Refreshes the rankings on a background thread, unless a refresh of the same
+        rankings is already underway.
+        """
+        refresh_key = '%s:refresh' % key
+        if not self.backend.add(refresh_key,True,self.channel_ttl(channel) or 60):
+            return # another refresh is underway
+
+        def run():
+            try:
+                self.fetch(client,key,channel,**params)
+            except Exception:
+                log.exception('Failed to refresh cached rankings for content channel %s.' % channel)
+            finally:
+                self.backend.delete(refresh_key)
+
+        thread = threading.Thread(target=run,name='djax-channel-refresh')
+        thread.daemon = True
+        thread.start()
+
+def build_channel_cache():
+    """
+    Builds the channel cache from the settings, or returns None if channel caching
+    is not enabled.
+    """
+    if not hasattr(settings,'DJAX_CHANNEL_CACHE') or not settings.DJAX_CHANNEL_CACHE:
+        return None
+
+    options = settings.DJAX_CHANNEL_CACHE_OPTIONS if hasattr(settings,'DJAX_CHANNEL_CACHE_OPTIONS') else {}
+    ttl = settings.DJAX_CHANNEL_CACHE_TTL if hasattr(settings,'DJAX_CHANNEL_CACHE_TTL') else 60
+    stale = settings.DJAX_CHANNEL_CACHE_STALE if hasattr(settings,'DJAX_CHANNEL_CACHE_STALE') else 0
+    return ChannelCache(build_backend(settings.DJAX_CHANNEL_CACHE,options),ttl=ttl,stale=stale)
+
+channel_cache = build_channel_cache()
+
+# ================
+# = Record Cache =
+# ================
+class RecordCache(object):
+    """
+    Identity map for content records, looked up either by local content type and id
+    or by ACE content type and key.  Records are cached as their field values, and a
+    fresh record instance is built for each hit.
+    """
+    def __init__(self,backend,timeout=3600):
+        self.backend = backend
+        self.timeout = timeout
+
+    def local_key(self,local_content_type_id,local_id):
+        return 'djax-record:local:%s:%s' % (local_content_type_id,local_id)
+
+    def ace_key(self,axilent_content_type,axilent_content_key):
+        return 'djax-record:ace:%s' % hashlib.md5(('%s:%s' % (axilent_content_type,axilent_content_key)).encode('utf-8')).hexdigest()
+
+    def get_local(self,model_class,local_content_type_id,local_id):
+        """
+        Gets the cached record of model_class for the local model, or None.
+        """
+        return self.build(model_class,self.backend.get(self.local_key(local_content_type_id,local_id)))
+
+    def get_ace(self,model_class,axilent_content_type,axilent_content_key):
+        """
+        Gets the cached record of model_class for the ACE content item, or None.
+        """
+        return self.build(model_class,self.backend.get(self.ace_key(axilent_content_type,axilent_content_key)))
+
+    def build(self,model_class,values):
+        if values is None:
+            return None
+        record = model_class(**values)
+        record._state.adding = False # the record exists in the database
+        return record
+
+    def set(self,record):
+        """
+        Caches the record under both of its keys.
+        """
+        values = dict((field.attname,getattr(record,field.attname)) for field in record._meta.fields)
+        self.backend.set(self.local_key(record.local_content_type_id,record.local_id),values,self.timeout)
+        self.backend.set(self.ace_key(record.axilent_content_type,record.axilent_content_key),values,self.timeout)
+
+    def invalidate(self,record):
+        """
+        Removes the record from the cache.
+        """
+        self.backend.delete(self.local_key(record.local_content_type_id,record.local_id))
+        self.backend.delete(self.ace_key(record.axilent_content_type,record.axilent_content_key))
+
+def build_record_cache():
+    """
+    Builds the record cache from the settings, or returns None if record caching is
+    not enabled.
+    """
+    if not hasattr(settings,'DJAX_RECORD_CACHE') or not settings.DJAX_RECORD_CACHE:
+        return None
+
+    options = settings.DJAX_RECORD_CACHE_OPTIONS if hasattr(settings,'DJAX_RECORD_CACHE_OPTIONS') else {}
+    timeout = settings.DJAX_RECORD_CACHE_TIMEOUT if hasattr(settings,'DJAX_RECORD_CACHE_TIMEOUT') else 3600
+    return RecordCache(build_backend(settings.DJAX_RECORD_CACHE,options),timeout=timeout)
+
+record_cache = build_record_cache()
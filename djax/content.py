@@ -3,15 +3,55 @@ Content sync for Djax
 """
 from djax.registry import content_registry, build_registry
 from djax.gateway import content_client, trigger_client
+from djax.cache import channel_cache
+from pax.concurrent import get_pool, gather
+import heapq
+import operator
+import threading
+import time
 import uuid
 import logging
-from django.db.models import Manager
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from django.db import connection
+from django.db.models import Manager, F, Q
 from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
 from pax.util import slugify
 import re
 
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
+try:
+    from django.db.models import Case, When, Value, IntegerField
+except ImportError:
+    Case = None # conditional expressions require Django 1.8
+
 log = logging.getLogger('djax')
 
+# ============
+# = Settings =
+# ============
+sync_batch_size = settings.DJAX_SYNC_BATCH_SIZE if hasattr(settings,'DJAX_SYNC_BATCH_SIZE') else 100
+sync_range_size = settings.DJAX_SYNC_RANGE_SIZE if hasattr(settings,'DJAX_SYNC_RANGE_SIZE') else 1000
+library_chunk_size = settings.DJAX_LIBRARY_CHUNK_SIZE if hasattr(settings,'DJAX_LIBRARY_CHUNK_SIZE') else 100
+library_workers = settings.DJAX_LIBRARY_WORKERS if hasattr(settings,'DJAX_LIBRARY_WORKERS') else 4
+sync_queue = settings.DJAX_SYNC_QUEUE if hasattr(settings,'DJAX_SYNC_QUEUE') else False
+sync_queue_window = settings.DJAX_SYNC_QUEUE_WINDOW if hasattr(settings,'DJAX_SYNC_QUEUE_WINDOW') else 5
+sync_queue_max_attempts = settings.DJAX_SYNC_QUEUE_MAX_ATTEMPTS if hasattr(settings,'DJAX_SYNC_QUEUE_MAX_ATTEMPTS') else 5
+
+class ContentSyncError(Exception):
+    """
+    One or more sync workers failed.  The errors attribute holds a list of
+    (content type, exception) tuples, one for each failure.
+    """
+    def __init__(self,errors):
+        self.errors = errors
+        super(ContentSyncError,self).__init__('; '.join(['%s: %s' % (content_type,unicode(error)) for content_type, error in errors]))
+
 class ACEContent(object):
     """
     Mixin to provide Axilent content sync services for Django models.
@@ -174,10 +214,9 @@ class DefaultFieldConverter(object):
         """
         Associated content link, if found, otherwise just assigns value.
         """
-        from djax.models import AxilentContentRecord
-        if re.match(r'^[\w\s]+:[A-Fa-f0-9]+$',ace_field_value):
+        if content_link_pattern.match(ace_field_value):
             ctype, ckey = ace_field_value.split(':')
-            local_model = AxilentContentRecord.objects.get_or_create_model(axilent_content_type=ctype,axilent_content_key=ckey)
+            local_model = resolve_content_link(ctype,ckey)
             log.debug('Converted content link %s to local model.' % ace_field_value)
             return local_model
         else:
@@ -213,11 +252,10 @@ class NullableForeignKeyConverter(object):
         """
         Associated content link or None.
         """
-        from djax.models import AxilentContentRecord
         if ace_field_value:
-            if re.match(r'^[\w\s]+:[A-Fa-f0-9]+$',ace_field_value):
+            if content_link_pattern.match(ace_field_value):
                 ctype, ckey = ace_field_value.split(':')
-                local_model = AxilentContentRecord.objects.get_or_create_model(axilent_content_type=ctype,axilent_content_key=ckey)
+                local_model = resolve_content_link(ctype,ckey)
                 log.debug('Converted content link %s to local model.' % ace_field_value)
                 return local_model
             else:
@@ -257,23 +295,26 @@ class M2MFieldConverter(object):
         """
         Converts to local model relations.
         """
-        from djax.models import AxilentContentRecord
         log.debug('Converting ace value %s to local model relations.' % ace_field_value)
-        added_models = []
+        linked_ids = set()
         for compound_key in ace_field_value:
             ctype, ckey = compound_key.split(':')
-            linked_model = AxilentContentRecord.objects.get_or_create_model(axilent_content_type=ctype,
-                                                                           axilent_content_key=ckey)
-            getattr(local_model,self.field).add(linked_model)
-            added_models.append(linked_model.pk)
-            log.debug('Building local model relation from content link %s.' % compound_key)
+            linked_model = resolve_content_link(ctype,ckey)
+            if linked_model is None:
+                continue
+            linked_ids.add(linked_model.pk)
         
-        # get rid of any relations not specified in the content link list
-        for stale_link in getattr(local_model,self.field).exclude(pk__in=added_models):
-            getattr(local_model,self.field).remove(stale_link)
-            log.debug('Removing stale link %s from local model.' % unicode(stale_link))
-        
-        local_model.save()
+        # diff against the current relations, and apply the changes in bulk
+        relation = getattr(local_model,self.field)
+        current_ids = set(relation.values_list('pk',flat=True))
+        to_add = linked_ids - current_ids
+        to_remove = current_ids - linked_ids
+        if to_add:
+            relation.add(*to_add)
+        if to_remove:
+            # get rid of any relations not specified in the content link list
+            relation.remove(*to_remove)
+        log.debug('Added %d and removed %d local model relations for %s.' % (len(to_add),len(to_remove),self.field))
     
     def to_ace(self,local_model):
         """
@@ -296,6 +337,287 @@ class WriteNullFieldConverter(DefaultFieldConverter):
     """
     accepts_null = True  
 
+# ===================
+# = Field Map Plans =
+# ===================
+_missing = object()
+
+class FieldMapPlan(object):
+    """
+    A field map compiled into field converters.  Immediate converters are held as
+    (axilent field, converter, local field, accepts null) tuples and deferred converters
+    as (axilent field, converter) tuples.  Plain string mappings get a DefaultFieldConverter.
+    """
+    def __init__(self,field_map):
+        immediate, deferred = [], []
+        for axilent_field, model_field in field_map.items():
+            if hasattr(model_field,'field'):
+                # this is a field converter
+                # sanity check
+                if not hasattr(model_field,'to_ace') or not hasattr(model_field,'to_local_model'):
+                    raise ValueError('You must define the methods to_ace and to_local_model for field converter for ace field %s.' % axilent_field)
+                
+                if getattr(model_field,'deferred',False):
+                    deferred.append((axilent_field,model_field))
+                else:
+                    immediate.append((axilent_field,model_field,model_field.field,bool(getattr(model_field,'accepts_null',False))))
+            else:
+                # just a string, use default field converter
+                immediate.append((axilent_field,DefaultFieldConverter(model_field),model_field,False))
+        
+        self.immediate = tuple(immediate)
+        self.deferred = tuple(deferred)
+        
+        link_converters = (DefaultFieldConverter,NullableForeignKeyConverter,M2MFieldConverter)
+        self.link_fields = tuple([entry[0] for entry in immediate + deferred if isinstance(entry[1],link_converters)])
+    
+    def content_links(self,axilent_content):
+        """
+        Gets the content links in the content's fields that are converted to local
+        models, as (content type, content key) tuples.
+        """
+        links = []
+        for axilent_field in self.link_fields:
+            value = getattr(axilent_content,axilent_field,None)
+            for link in (value if isinstance(value,(list,tuple)) else [value]):
+                if isinstance(link,basestring) and content_link_pattern.match(link):
+                    links.append(tuple(link.split(':')))
+        return links
+    
+    def local_fields(self,axilent_content):
+        """
+        Converts the ACE content to a dictionary of local field values, for creating a
+        local model.  Fields missing from the content are left out.
+        """
+        fields = {}
+        for axilent_field, converter, local_field, accepts_null in self.immediate:
+            value = getattr(axilent_content,axilent_field,_missing)
+            if value is _missing:
+                log.info('Skipping ace field %s - not in data from ace.' % axilent_field)
+                continue
+            try:
+                fields[local_field] = converter.to_local_model(axilent_content,value)
+            except AttributeError:
+                log.exception('Local model has no field %s (matched to Axilent field %s).' % (local_field,axilent_field))
+        return fields
+    
+    def apply(self,axilent_content,local_model):
+        """
+        Sets the local model's fields from the ACE content.  Fields missing from the
+        content are skipped, unless their converter accepts null, in which case they
+        are set to None.
+        """
+        for axilent_field, converter, local_field, accepts_null in self.immediate:
+            value = getattr(axilent_content,axilent_field,_missing)
+            if value is not _missing:
+                setattr(local_model,local_field,converter.to_local_model(axilent_content,value))
+            elif accepts_null:
+                setattr(local_model,local_field,None)
+            else:
+                log.info('Skipping field %s - not in data from ACE.' % axilent_field)
+    
+    def apply_deferred(self,axilent_content,local_model):
+        """
+        Runs the deferred converters against the saved local model.
+        """
+        for axilent_field, converter in self.deferred:
+            value = getattr(axilent_content,axilent_field,_missing)
+            if value is _missing:
+                log.info('Skipping deferred field %s - not in data from ACE.' % axilent_field)
+                continue
+            try:
+                converter.to_local_model(axilent_content,value,local_model)
+            except AttributeError:
+                log.exception('Local model has no field %s (matched to Axilent field %s).' % (converter.field,axilent_field))
+
+_field_map_plans = {}
+
+def field_map_plan(model_class):
+    """
+    Gets the compiled field map plan for the model class, or None if the model does
+    not define a field map.  Plans are compiled once per model class.
+    """
+    try:
+        return _field_map_plans[model_class]
+    except KeyError:
+        pass
+    
+    try:
+        field_map = model_class.ACE.field_map
+    except AttributeError:
+        return None
+    
+    plan = FieldMapPlan(field_map)
+    _field_map_plans[model_class] = plan
+    return plan
+
+# ===========================
+# = Content Link Resolution =
+# ===========================
+content_link_pattern = re.compile(r'^[\w\s]+:[A-Fa-f0-9]+$')
+
+_resolution = threading.local()
+
+class ContentLinkResolver(object):
+    """
+    Resolves content links to local models for the field converters, while active:
+    
+        with ContentLinkResolver() as resolver:
+            resolver.prefetch(items)
+            ...
+    
+    Prefetching loads the local models for all of the links in a batch of content
+    with one query, and creates the models for missing links from one bulk fetch of
+    their content per content type (following the links of the fetched content in
+    turn).  The fetched content is created leaves first.  Resolved links are
+    remembered for as long as the resolver is active.
+    
+    A link back to content whose local model is still being created is a cycle, and
+    resolves to None rather than recursing.  The content holding the link is synced
+    again once the outermost model being created is done, when the link resolves.
+    """
+    def __init__(self):
+        self.models = {}
+        self.fetched = {}
+        self.creating = [] # stack of the links whose models are being created
+        self.incomplete = {} # links left unresolved by a cycle, of content link to content (if fetched)
+        self.previous = None
+    
+    def __enter__(self):
+        self.previous = getattr(_resolution,'resolver',None)
+        _resolution.resolver = self
+        return self
+    
+    def __exit__(self,exc_type,exc_value,traceback):
+        _resolution.resolver = self.previous
+    
+    def prefetch(self,items):
+        """
+        Resolves the content links in the ACE content items ahead of conversion.
+        """
+        from djax.models import AxilentContentRecord
+        
+        build_registry() # ensure registry is built
+        levels = []
+        links = set(self.item_links(items))
+        while links:
+            links = links.difference(self.models,self.fetched,self.creating)
+            if not links:
+                break
+            
+            records = AxilentContentRecord.objects.get_by_content_keys(links)
+            local_models = AxilentContentRecord.objects.local_models(records.values())
+            for link, record in records.items():
+                if record.pk in local_models:
+                    self.models[link] = local_models[record.pk]
+            
+            missing = links.difference(records)
+            keys_by_type = {}
+            for content_type, content_key in missing:
+                keys_by_type.setdefault(content_type,[]).append(content_key)
+            
+            fetched = []
+            for content_type, content_keys in keys_by_type.items():
+                fetched.extend(content_client.get_content_batch(content_type,content_keys))
+            for axilent_content in fetched:
+                self.fetched[(axilent_content.content_type,axilent_content.key)] = axilent_content
+            levels.append([(axilent_content.content_type,axilent_content.key) for axilent_content in fetched])
+            
+            log.debug('Prefetched %d content links, %d to be created.' % (len(links),len(fetched)))
+            links = set(self.item_links(fetched))
+        
+        # create the models for the missing links leaves first, so that their links are already resolved
+        for level in reversed(levels):
+            for link in level:
+                if link in self.fetched:
+                    self.create(link)
+    
+    def item_links(self,items):
+        """
+        Gets the content links of the items.
+        """
+        links = []
+        for axilent_content in items:
+            model_class = content_registry.get(axilent_content.content_type)
+            plan = field_map_plan(model_class) if model_class else None
+            if plan:
+                links.extend(plan.content_links(axilent_content))
+        return links
+    
+    def create(self,link):
+        """
+        Creates the local model for the link from its fetched content.
+        """
+        from djax.models import AxilentContentRecord
+        
+        axilent_content = self.fetched.pop(link)
+        return self.build(link,lambda: AxilentContentRecord.objects.create_model(link[0],link[1],content_data=axilent_content)[0],axilent_content)
+    
+    def build(self,link,build_model,axilent_content=None):
+        """
+        Builds the local model for the link with build_model, holding the link on the
+        creating stack meanwhile.  Completes any content left incomplete by a cycle once
+        the outermost model is built.
+        """
+        self.creating.append(link)
+        try:
+            local_model = build_model()
+            self.models[link] = local_model
+        finally:
+            self.creating.pop()
+        
+        if link in self.incomplete:
+            self.incomplete[link] = axilent_content
+        if not self.creating:
+            self.complete()
+        return local_model
+    
+    def complete(self):
+        """
+        Syncs the content whose links were left unresolved by a cycle, now that the
+        linked models exist.
+        """
+        from djax.models import AxilentContentRecord
+        
+        incomplete, self.incomplete = self.incomplete, {}
+        for link, axilent_content in incomplete.items():
+            if not link in self.models:
+                continue # the model was never created
+            record = AxilentContentRecord.objects.get_by_content_key(link[0],link[1])
+            record.sync_content(axilent_content or content_client.get_content(link[0],link[1]))
+            log.info('Resolved the content links of %s:%s left unresolved by a cycle.' % link)
+    
+    def resolve(self,content_type,content_key):
+        """
+        Gets the local model for the content link, creating it if necessary.
+        """
+        from djax.models import AxilentContentRecord
+        
+        link = (content_type,content_key)
+        if link in self.models:
+            return self.models[link]
+        if link in self.creating:
+            # the content being converted is synced again once the cycle is created
+            log.info('Content link %s:%s is part of a cycle, resolving it once the cycle is created.' % link)
+            self.incomplete.setdefault(self.creating[-1],None)
+            return None
+        if link in self.fetched:
+            return self.create(link)
+        
+        return self.build(link,lambda: AxilentContentRecord.objects.get_or_create_model(content_type,content_key))
+
+def resolve_content_link(content_type,content_key):
+    """
+    Gets the local model for the content link, through the active ContentLinkResolver
+    if there is one.
+    """
+    from djax.models import AxilentContentRecord
+    
+    resolver = getattr(_resolution,'resolver',None)
+    if resolver:
+        return resolver.resolve(content_type,content_key)
+    return AxilentContentRecord.objects.get_or_create_model(axilent_content_type=content_type,axilent_content_key=content_key)
+
 
 # ======================
 # = Content Operations =
@@ -319,93 +641,453 @@ def sync_record(content_type,content_key):
         AxilentContentRecord.objects.create_model(content_type,content_key)
         return True # new record created
 
-def sync_content_type(content_type):
+def sync_content_type(content_type,content_keys=None,index=None):
+    """
+    Syncs a specific content type.  If content_keys is specified only those keys
+    are synced.  The keys are checked against a record index (see
+    AxilentContentRecordManager.record_index), which is loaded if not supplied.
+    """
+    from djax.models import AxilentContentRecord
+    
+    if content_keys is None:
+        content_keys = content_client.content_keys(content_type)
+    if index is None:
+        index = AxilentContentRecord.objects.record_index(content_type)
+    
+    # one resolver per chunk of keys, so the resolved models are not held for the whole run
+    for chunk in chunks(content_keys,sync_batch_size):
+        with ContentLinkResolver():
+            for content_key in chunk:
+                if content_key in index:
+                    local_id, updated = index[content_key]
+                    if is_stale(updated,content_client.latest_update(content_type,content_key)):
+                        log.debug('Syncing local model %s:%s with updated content from ACE' % (content_type,content_key))
+                        record = AxilentContentRecord.objects.get(axilent_content_type=content_type,
+                                                                  axilent_content_key=content_key)
+                        record.sync_content(content_client.get_content(content_type,content_key))
+                else:
+                    # the record may have been created since the index was loaded, by a content link from an earlier item
+                    resolve_content_link(content_type,content_key)
+
+def chunks(sequence,size):
     """
-    Syncs a specific content type.
+    Splits the sequence into lists of at most size items.
+    """
+    chunk = []
+    for item in sequence:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def is_stale(updated,latest):
+    """
+    Determines if a local record last updated at updated is behind the latest
+    update from ACE.
+    """
+    return not (updated and latest and updated >= latest)
+
+def sync_content_type_batched(content_type,batch_size=None,content_keys=None,index=None):
+    """
+    Syncs a specific content type in batches.  Stale keys are found with one bulk
+    update check per batch, their content is fetched with one bulk call and the
+    changes are applied within a single transaction.  If content_keys is specified
+    only those keys are synced.  As with sync_content_type, a record index is loaded
+    if not supplied.
+    
+    Returns a 2-tuple of the number of local models created and updated.
     """
     from djax.models import AxilentContentRecord
     
-    content_keys = content_client.content_keys(content_type)
-    for content_key in content_keys:
+    batch_size = batch_size or sync_batch_size
+    created, updated = 0, 0
+    
+    if content_keys is None:
+        content_keys = content_client.content_keys(content_type)
+    if index is None:
+        index = AxilentContentRecord.objects.record_index(content_type)
+    
+    for batch in chunks(content_keys,batch_size):
+        indexed_keys = [key for key in batch if key in index]
+        latest = content_client.latest_updates(content_type,indexed_keys) if indexed_keys else {}
+        stale_keys = [key for key in batch if not key in index or is_stale(index[key][1],latest.get(key))]
+        if not stale_keys:
+            continue
+        
+        items = content_client.get_content_batch(content_type,stale_keys)
+        
+        with atomic(), ContentLinkResolver() as resolver:
+            # resolve the content links of the whole batch up front
+            resolver.prefetch(items)
+            
+            # records may have been created since the index was loaded, by content links from earlier items
+            records = dict((record.axilent_content_key,record) for record in AxilentContentRecord.objects.filter(axilent_content_type=content_type,
+                                                                                                                  axilent_content_key__in=stale_keys))
+            for axilent_content in items:
+                record = records.get(axilent_content.key)
+                if record:
+                    log.debug('Syncing local model %s:%s with updated content from ACE' % (content_type,axilent_content.key))
+                    record.sync_content(axilent_content)
+                    updated += 1
+                else:
+                    AxilentContentRecord.objects.create_model(content_type,axilent_content.key,content_data=axilent_content)
+                    created += 1
+        
+        log.info('Synced %d stale %s items out of a batch of %d.' % (len(stale_keys),content_type,len(batch)))
+    
+    return (created,updated)
+
+def content_keys_to_sync(content_type,incremental=False):
+    """
+    Gets the keys of the content type to sync.  An incremental sync gets only the keys
+    of content changed since the content type's watermark, falling back to all of the
+    keys if the content type has no watermark yet.
+    
+    Returns a 3-tuple of the content keys, and the sync time and cursor to advance the
+    watermark to once the keys have been synced.
+    """
+    from djax.models import ContentSyncWatermark
+    
+    started = datetime.now() # changes made while syncing are picked up by the next sync
+    if incremental:
         try:
-            record = AxilentContentRecord.objects.get(axilent_content_type=content_type,
-                                                      axilent_content_key=content_key)
-            axilent_content = record.get_update()
-            if axilent_content:
-                log.debug('Syncing local model %s:%s with updated content from ACE' % (record.axilent_content_type,record.axilent_content_key))
-                record.sync_content(axilent_content)
-        except AxilentContentRecord.DoesNotExist:
-            AxilentContentRecord.objects.create_model(content_type,content_key)
+            watermark = ContentSyncWatermark.objects.get(content_type=content_type)
+        except ContentSyncWatermark.DoesNotExist:
+            watermark = None
+        
+        if watermark and (watermark.synced_at or watermark.cursor):
+            content_keys, cursor = content_client.changed_content_keys(content_type,since=watermark.synced_at,cursor=watermark.cursor)
+            log.info('%d %s items changed since the last sync.' % (len(content_keys),content_type))
+            return (content_keys,started,cursor)
+        
+        log.info('No sync watermark for %s, falling back to a full sync.' % content_type)
+    
+    return (content_client.content_keys(content_type),started,None)
 
-def sync_content(token=None,content_type_to_sync=None):
+def _run_in_worker(content_type,func,*args):
+    """
+    Runs func on a sync worker thread.  Returns a 2-tuple of the result and the
+    exception raised, if any.  The worker's database connection is closed afterwards,
+    as each thread gets its own connection.
     """
-    Synchronizes the local models with Axilent content.
+    try:
+        return (func(*args),None)
+    except Exception as e:
+        log.exception('Sync worker failed while syncing %s.' % content_type)
+        return (None,e)
+    finally:
+        connection.close()
+
+def sync_content_parallel(content_types,workers,batch_size=None,incremental=False,leases=None):
     """
-    from djax.models import ContentSyncLock
+    Syncs the content types on a pool of worker threads.  The keys of each content
+    type are split into ranges, and the ranges are synced concurrently.  The watermarks
+    of the content types synced without error are advanced.  Raises a ContentSyncError
+    holding the errors from all of the workers if any of them failed.
     
-    if ContentSyncLock.objects.all().exists():
-        return False # already sync locked
+    If the SyncLeases held for the content types are given, the remaining ranges of a
+    content type whose lease is lost are skipped, and its watermark is not advanced.
+    """
+    from djax.models import AxilentContentRecord, ContentSyncWatermark
     
-    if not token:
-        token = uuid.uuid4().hex
+    def fetch_keys(content_type):
+        return _run_in_worker(content_type,lambda: (content_keys_to_sync(content_type,incremental),
+                                                    AxilentContentRecord.objects.record_index(content_type)))
     
-    lock = ContentSyncLock.objects.create(token=token)
+    def sync_range(task):
+        content_type, key_range, index = task
+        if leases and not leases.held(content_type):
+            return (None,None) # another sync has taken over the content type
+        if batch_size:
+            return _run_in_worker(content_type,sync_content_type_batched,content_type,batch_size,key_range,index)
+        else:
+            return _run_in_worker(content_type,sync_content_type,content_type,key_range,index)
     
+    errors = []
+    watermarks = {}
+    pool = ThreadPool(workers)
+    try:
+        tasks = []
+        for content_type, (keys_and_index, error) in zip(content_types,pool.map(fetch_keys,content_types)):
+            if error:
+                errors.append((content_type,error))
+            else:
+                (content_keys, synced_at, cursor), index = keys_and_index
+                watermarks[content_type] = (synced_at,cursor)
+                tasks.extend([(content_type,key_range,index) for key_range in chunks(content_keys,sync_range_size)])
+        
+        log.info('Syncing %d key ranges of %d content types with %d workers.' % (len(tasks),len(content_types),workers))
+        for (content_type, key_range, index), (result, error) in zip(tasks,pool.map(sync_range,tasks)):
+            if error:
+                errors.append((content_type,error))
+                watermarks.pop(content_type,None)
+    finally:
+        pool.close()
+        pool.join()
+    
+    for content_type, (synced_at, cursor) in watermarks.items():
+        if leases and not leases.held(content_type):
+            continue
+        ContentSyncWatermark.objects.advance(content_type,synced_at,cursor)
+    
+    if errors:
+        raise ContentSyncError(errors)
+
+def registry_content_types(content_type_to_sync=None):
+    """
+    Gets the content types to sync: the specified content type, or all registered
+    content types.
+    """
     # ensure content registry loaded
     build_registry()
     
     if content_type_to_sync:
-        log.info('Syncing %s.' % content_type_to_sync)
-        try:
-            content_type = content_registry[content_type_to_sync]
-            sync_content_type(content_type_to_sync)
-        except KeyError:
-            log.error('%s is not in the content registry.' % content_type_to_sync)
-    else:
-        for content_type in content_registry.keys():
-            sync_content_type(content_type)
-    
-    lock.delete()
+        if content_type_to_sync in content_registry:
+            return [content_type_to_sync]
+        log.error('%s is not in the content registry.' % content_type_to_sync)
+        return []
+    return content_registry.keys()
+
+def sync_content(token=None,content_type_to_sync=None,batch_size=None,workers=None,incremental=False):
+    """
+    Synchronizes the local models with Axilent content.  If a batch size is specified
+    the content types are synced in batches of that many keys.  If more than one
+    worker is specified the content types are synced concurrently, and a ContentSyncError
+    is raised if any of the workers failed.  An incremental sync only syncs the content
+    changed since the last sync of each content type (see content_keys_to_sync).
+    
+    Each content type is synced under a lease (see SyncLeases), and content types
+    being synced by another sync are skipped.  A serial sync only holds the lease of
+    the content type it is syncing, so that other syncs can take the others meanwhile.
+    The watermark of a content type whose lease was lost during the sync is not
+    advanced.  Returns False if all of the content types were locked.
+    """
+    from djax.models import ContentSyncWatermark, SyncLeases
+    
+    if not token:
+        token = uuid.uuid4().hex
+    
+    content_types = registry_content_types(content_type_to_sync)
+    leases = SyncLeases('content',token)
+    synced = 0
+    try:
+        if workers and workers > 1:
+            leased = leases.acquire(content_types)
+            if leased:
+                sync_content_parallel(leased,workers,batch_size,incremental,leases)
+            synced = len(leased)
+        else:
+            for content_type in content_types:
+                if not leases.acquire([content_type]):
+                    continue
+                try:
+                    log.info('Syncing %s.' % content_type)
+                    content_keys, synced_at, cursor = content_keys_to_sync(content_type,incremental)
+                    if batch_size:
+                        sync_content_type_batched(content_type,batch_size,content_keys)
+                    else:
+                        sync_content_type(content_type,content_keys)
+                    if leases.held(content_type):
+                        ContentSyncWatermark.objects.advance(content_type,synced_at,cursor)
+                finally:
+                    leases.release([content_type])
+                synced += 1
+    finally:
+        leases.release()
+    
+    if content_types and not synced:
+        return False # already sync locked
     return True # sync occured
 
-def sync_library_to_content_type(content_type):
+def drain_sync_queue(window=None,batch_size=None,limit=None,token=None):
+    """
+    Syncs the content queued by the sync record webhook (see PendingContentSync).  Only
+    items last requested at least window seconds ago are synced, so that a burst of
+    requests for an item is synced once.  The items are synced in batches, with
+    sync_content_type_batched, under a 'queue' lease held while each content type is
+    drained.  If a batch fails its items are synced one at a time, and the items that
+    fail are left queued to be retried by the next drain, until they have failed
+    max_attempts times (DJAX_SYNC_QUEUE_MAX_ATTEMPTS), when they are dropped from the
+    queue.
+    
+    Returns a 2-tuple of the number of items synced and failed.
+    """
+    from djax.models import AxilentContentRecord, PendingContentSync, SyncLeases
+    
+    window = sync_queue_window if window is None else window
+    batch_size = batch_size or sync_batch_size
+    if not token:
+        token = uuid.uuid4().hex
+    
+    due = PendingContentSync.objects.due(window)
+    if limit:
+        due = due[:limit]
+    
+    pending_by_type = {}
+    for pending in due:
+        pending_by_type.setdefault(pending.axilent_content_type,[]).append(pending)
+    
+    def sync_batch(content_type,batch):
+        content_keys = [pending.axilent_content_key for pending in batch]
+        index = AxilentContentRecord.objects.record_index(content_type,content_keys)
+        sync_content_type_batched(content_type,batch_size,content_keys,index)
+        
+        # items requested again since they were read stay queued
+        unchanged = reduce(operator.or_,[Q(pk=pending.pk,requested__lte=pending.requested) for pending in batch])
+        PendingContentSync.objects.filter(unchanged).delete()
+    
+    def sync_failed(pending):
+        if pending.attempts + 1 >= sync_queue_max_attempts:
+            log.error('Giving up on queued sync of %s:%s after %d attempts.' % (pending.axilent_content_type,pending.axilent_content_key,pending.attempts + 1))
+            pending.delete()
+        else:
+            PendingContentSync.objects.filter(pk=pending.pk).update(attempts=F('attempts') + 1)
+    
+    synced, failed = 0, 0
+    leases = SyncLeases('queue',token)
+    try:
+        for content_type in pending_by_type.keys():
+            if not leases.acquire([content_type]):
+                continue
+            try:
+                for batch in chunks(pending_by_type[content_type],batch_size):
+                    if not leases.held(content_type):
+                        break # another drain has taken over the content type
+                    try:
+                        sync_batch(content_type,batch)
+                        synced += len(batch)
+                        continue
+                    except Exception:
+                        log.exception('Failed to sync %d queued %s items, syncing them one at a time.' % (len(batch),content_type))
+                
+                    # the batch was rolled back, so sync its items on their own to find the ones that fail
+                    for pending in batch:
+                        try:
+                            sync_batch(content_type,[pending])
+                            synced += 1
+                        except Exception:
+                            log.exception('Failed to sync queued item %s:%s.' % (content_type,pending.axilent_content_key))
+                            sync_failed(pending)
+                            failed += 1
+            finally:
+                leases.release([content_type])
+    finally:
+        leases.release()
+    
+    if synced or failed:
+        log.info('Drained the sync queue: %d items synced, %d failed.' % (synced,failed))
+    return (synced,failed)
+
+def model_chunks(queryset,size):
+    """
+    Iterates through the queryset in chunks of at most size models, in pk order.
+    Each chunk is loaded with its own query, so the whole queryset is never held
+    in memory.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = list((queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset)[:size])
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1].pk
+
+def sync_library_to_content_type(content_type,chunk_size=None,workers=None):
     """ 
-    Syncs the ACE library to the specified content type.
+    Syncs the ACE library to the specified content type.  The local models are pushed
+    in pk-ordered chunks, with the records of each chunk loaded with one query, and
+    the models of a chunk are pushed concurrently by a pool of workers.  A failed push
+    doesn't stop the others; a ContentSyncError holding the error of each failed push
+    is raised once all of the models have been pushed.
+    
+    Returns a 2-tuple of the number of models pushed and the number skipped because
+    they had not changed since their last push.
     """
+    from djax.models import AxilentContentRecord
+    
+    chunk_size = chunk_size or library_chunk_size
+    workers = workers or library_workers
     content_model = content_registry[content_type]
-    for item in content_model.objects.all():
-        item.push_to_library()
+    
+    def push(task):
+        # each model is pushed on its own, so that one failure doesn't stop the rest of the slice
+        models, records = task
+        results = []
+        try:
+            for model in models:
+                try:
+                    results.append((AxilentContentRecord.objects.push_to_library(model,records),None))
+                except Exception as e:
+                    log.exception('Failed to push %s %s to the ACE library.' % (content_type,unicode(model)))
+                    results.append((None,e))
+        finally:
+            connection.close()
+        return results
+    
+    errors = []
+    pushed, unchanged = 0, 0
+    pool = ThreadPool(workers)
+    try:
+        for chunk in model_chunks(content_model.objects.all(),chunk_size):
+            started = time.time()
+            records = AxilentContentRecord.objects.get_records(chunk)
+            tasks = [(chunk[i::workers],records) for i in range(min(workers,len(chunk)))]
+            chunk_pushed = 0
+            for results in pool.map(push,tasks):
+                for result, error in results:
+                    if error:
+                        errors.append((content_type,error))
+                    elif result[0]:
+                        chunk_pushed += 1
+                    else:
+                        unchanged += 1
+            pushed += chunk_pushed
+            elapsed = time.time() - started
+            log.info('Checked %d %s items in %.2fs (%.1f items/s), pushed %d changed items to the ACE library.' % (len(chunk),content_type,elapsed,
+                                                                                                                    len(chunk) / elapsed if elapsed else 0,
+                                                                                                                    chunk_pushed))
+    finally:
+        pool.close()
+        pool.join()
+    
+    log.info('Pushed %d %s items to the ACE library, %d unchanged.' % (pushed,content_type,unchanged))
+    if errors:
+        raise ContentSyncError(errors)
+    return (pushed,unchanged)
 
 def sync_library(token=None,content_type_to_sync=None):
     """ 
-    Synchronizes the ACE library with the local content.
+    Synchronizes the ACE library with the local content.  As with sync_content, each
+    content type is pushed under a lease, held only while the content type is pushed.
+    Returns False if all of the content types were locked.
     """
-    from djax.models import ContentSyncLock
-    
-    if ContentSyncLock.objects.all().exists():
-        return False
+    from djax.models import SyncLeases
     
     if not token:
         token = uuid.uuid4().hex
     
-    lock = ContentSyncLock.objects.create(token=token)
-    
-    # ensure registry loaded
-    build_registry()
+    content_types = registry_content_types(content_type_to_sync)
+    leases = SyncLeases('library',token)
+    pushed = 0
+    try:
+        for content_type in content_types:
+            # each content type is leased only while it is pushed, so other syncs can take the rest
+            if not leases.acquire([content_type]):
+                continue
+            try:
+                log.info('Pushing %s content to ACE library.' % content_type)
+                sync_library_to_content_type(content_type)
+            finally:
+                leases.release([content_type])
+            pushed += 1
+    finally:
+        leases.release()
     
-    if content_type_to_sync:
-        log.info('Pushing %s content to ACE library.' % content_type_to_sync)
-        try:
-            content_type = content_registry[content_type_to_sync]
-            sync_library_to_content_type(content_type_to_sync)
-        except KeyError:
-            log.error('%s is not in the content registry.' % content_type_to_sync)
-    else:
-        for content_type in content_registry.keys():
-            log.info('Pushing %s content to ACE library.' % content_type)
-            sync_library_to_content_type(content_type)
-    
-    lock.delete()
+    if content_types and not pushed:
+        return False
     return True
 
 # ===================
@@ -437,43 +1119,92 @@ class ContentChannel(object):
         
         return p
     
-    def get_content(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,include_endorsements=False):
+    def fetch(self,channel=None,profile=None,basekey=None,flavor=None,limit=0):
         """
-        Gets content.  Flavor and limit params will override the defaults.
-        Extracts relevant content from the supplied queryset.
+        Gets the channel items from ACE, or from the channel cache if it is enabled.
+        Flavor and limit params will override the defaults.
         """
-        from djax.models import AxilentContentRecord
-        
-        ctype = ContentType.objects.get_for_model(queryset.model)
         params = self._build_params(profile=profile,basekey=basekey,flavor=flavor,limit=limit)
         
         if not channel and not self.name:
             raise ValueError('Content Channel unspecified.  You must either specify the channel in the call or the constructor.')
         
-        channel_slug = slugify(channel or self.channel)
+        channel_slug = slugify(channel or self.name)
         
-        axl_content_type = queryset.model.ACE.content_type
+        if channel_cache:
+            return channel_cache.channel(self.api,channel_slug,**params)
+        else:
+            return self.api.channel(channel_slug,**params).items
+    
+    def records(self,queryset,items):
+        """
+        Gets the records of the channel items that are in the supplied queryset, with
+        one query.  Returns a dictionary of (ACE content type, key) to record.
+        """
+        from djax.models import AxilentContentRecord
         
-        results = self.api.channel(channel_slug,**params)
+        records = {}
+        if items:
+            ctype = ContentType.objects.get_for_model(queryset.model)
+            queryset_keys = queryset.values_list('id',flat=True)
+            for record in AxilentContentRecord.objects.filter(local_content_type=ctype,
+                                                              local_id__in=queryset_keys,
+                                                              axilent_content_key__in=set([content_item.key for content_item in items])):
+                records[(record.axilent_content_type,record.axilent_content_key)] = record
+        return records
+    
+    def resolve_ids(self,queryset,items):
+        """
+        Resolves the channel items to a list of (local id, endorsement) tuples for the
+        local models in the supplied queryset, keeping the channel order.
+        """
+        records = self.records(queryset,items)
+        return [(records[(content_item.content_type,content_item.key)].local_id,content_item.endorsement)
+                for content_item in items if (content_item.content_type,content_item.key) in records]
+    
+    def resolve(self,queryset,items,include_endorsements=False):
+        """
+        Resolves the channel items to the local models in the supplied queryset, keeping
+        the channel order.
+        """
+        from djax.models import AxilentContentRecord
+        
+        axl_content_type = queryset.model.ACE.content_type
         
-        queryset_keys = queryset.values_list('id',flat=True)
+        # resolve all of the channel items with one record query and one query per local model class
+        records = self.records(queryset,items)
+        local_models = AxilentContentRecord.objects.local_models(records.values())
         
         return_set = []
         
-        for content_item in results.items:
-            try:
-                record = AxilentContentRecord.objects.get(axilent_content_type=content_item.content_type,
-                                                          axilent_content_key=content_item.key,
-                                                          local_id__in=queryset_keys)
+        for content_item in items:
+            record = records.get((content_item.content_type,content_item.key))
+            if record and record.pk in local_models:
                 if include_endorsements:
-                    return_set.append(ContentItemWrapper(record.get_local_model(),content_item.endorsement))
+                    return_set.append(ContentItemWrapper(local_models[record.pk],content_item.endorsement))
                 else:
-                    return_set.append(record.get_local_model())
-            except AxilentContentRecord.DoesNotExist:
+                    return_set.append(local_models[record.pk])
+            else:
                 log.warn('No local record of %s:%s, referenced by Content Channel %s' % (axl_content_type,content_item.key,self.name))
             
         return return_set
     
+    def get_content(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,include_endorsements=False):
+        """
+        Gets content.  Flavor and limit params will override the defaults.
+        Extracts relevant content from the supplied queryset.
+        """
+        items = self.fetch(channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
+        return self.resolve(queryset,items,include_endorsements=include_endorsements)
+    
+    def get_content_async(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,include_endorsements=False):
+        """
+        Like get_content, but fetches the channel items from ACE on the shared pool.
+        Returns a ContentFuture.
+        """
+        pending = get_pool().apply_async(self.fetch,(),{'channel':channel,'profile':profile,'basekey':basekey,'flavor':flavor,'limit':limit})
+        return ContentFuture(pending,lambda items: self.resolve(queryset,items,include_endorsements=include_endorsements))
+    
     def __call__(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,include_endorsements=False):
         """
         Function hook - passes through to get_content.
@@ -491,7 +1222,7 @@ class ContentManager(Manager):
         super(ContentManager,self).__init__()
         
         if channel:
-            self._channel = ContentChannel(channel=channel,flavor=flavor,limit=limit)
+            self._channel = ContentChannel(name=channel,flavor=flavor,limit=limit)
         else:
             self._channel = ContentChannel()
     
@@ -502,6 +1233,14 @@ class ContentManager(Manager):
         from djax.models import AxilentContentRecord
         return AxilentContentRecord.objects.search(self.model,query)
     
+    def search_async(self,query):
+        """
+        Like search, but runs the ACE search on the shared pool.  Returns a ContentFuture.
+        """
+        from djax.models import AxilentContentRecord
+        pending = get_pool().apply_async(content_client.search,(query,self.model.ACE.content_type))
+        return ContentFuture(pending,lambda search_results: AxilentContentRecord.objects.search_results(self.model,search_results))
+    
     def channel(self,channel=None,profile=None,basekey=None,flavor=None,limit=0):
         """
         Gets content matching the channel results
@@ -511,41 +1250,155 @@ class ContentManager(Manager):
         
         return self._channel(self.all(),channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
     
-    def channel_sort(self,queryset,channel=channel,profile=None,basekey=None,flavor=None,limit=0):
+    def channel_async(self,channel=None,profile=None,basekey=None,flavor=None,limit=0):
+        """
+        Like channel, but fetches the channel results from ACE on the shared pool.
+        Returns a ContentFuture.  Use gather to wait for several futures.
+        """
+        if not self._channel.name and not channel:
+            raise ValueError('Content Channel not defined.  You must either specify it as an argument, or pass a default channel to the constructor.')
+        
+        return self._channel.get_content_async(self.all(),channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
+    
+    def channel_sort(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,lazy=False,top=None):
         """
         Sorts the passed queryset by rlevel, with the most relevant results first.
+        If top is specified only the first top results are returned, and only as many
+        rows as are needed are loaded from the queryset.
+        
+        If lazy is true the sort is done in the database (requires Django 1.8): a
+        queryset is returned, ordered by the channel rlevel and annotated with it
+        as channel_rlevel, which may be paginated without loading the whole queryset.
         """
+        if lazy:
+            items = self._channel.fetch(channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit)
+            ranked_ids = self._channel.resolve_ids(queryset,items)
+            queryset = queryset.annotate(channel_rlevel=self._rank_expression(ranked_ids,0),
+                                         channel_position=self._rank_expression([(local_id,position) for position, (local_id, rlevel) in enumerate(ranked_ids)],len(ranked_ids)))
+            return self._order_by(queryset,'-channel_rlevel','channel_position')
+        
         channel_results = self._channel(queryset,channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit,include_endorsements=True)
+        return self._sort_channel_results(queryset,channel_results,top=top)
+    
+    def channel_sort_async(self,queryset,channel=None,profile=None,basekey=None,flavor=None,limit=0,top=None):
+        """
+        Like channel_sort, but fetches the channel results from ACE on the shared pool.
+        Returns a ContentFuture.
+        """
+        future = self._channel.get_content_async(queryset,channel=channel,profile=profile,basekey=basekey,flavor=flavor,limit=limit,include_endorsements=True)
+        return ContentFuture(future,lambda channel_results: self._sort_channel_results(queryset,channel_results,top=top))
+    
+    def _sort_channel_results(self,queryset,channel_results,top=None):
+        """
+        Merges the remainder of the queryset into the endorsed channel results, sorted by rlevel.
+        """
+        if top is not None:
+            return self._top_channel_results(queryset,channel_results,top)
+        
         remainder_results = queryset.exclude(pk__in=[item.pk for item in channel_results])
         final_results = channel_results + [ContentItemWrapper(item,0) for item in remainder_results]
         final_results.sort(cmp=lambda x,y: cmp(y.rlevel,x.rlevel))
         return final_results
     
-    def search_sort(self,queryset,query):
+    def _top_channel_results(self,queryset,channel_results,top):
+        """
+        Gets the first top results of _sort_channel_results, without sorting or loading
+        the whole queryset.  Remainder rows have an rlevel of 0, and rank after channel
+        results of the same rlevel, so they fill in between the non-negative and the
+        negative channel results.
+        """
+        ranked = heapq.nlargest(top,channel_results,key=lambda item: item.rlevel) # stable for equal rlevels
+        final_results = [item for item in ranked if item.rlevel >= 0]
+        
+        if len(final_results) < top:
+            remainder_results = queryset.exclude(pk__in=[item.pk for item in channel_results])[:top - len(final_results)]
+            final_results.extend([ContentItemWrapper(item,0) for item in remainder_results])
+        
+        if len(final_results) < top:
+            final_results.extend([item for item in ranked if item.rlevel < 0][:top - len(final_results)])
+        
+        return final_results
+    
+    def search_sort(self,queryset,query,lazy=False):
         """
         Reorders queryset based on matching items from search query.
+        
+        If lazy is true the sort is done in the database (requires Django 1.8): a
+        queryset is returned, ordered by search rank and annotated with it as
+        search_rank, which may be paginated without loading the whole queryset.
         """
-        search_results = self.search(query).filter(pk__in=[item.pk for item in queryset])
-        remainder_results = queryset.exclude(pk__in=[item.pk for item in search_results])
-        final_results = [item for item in search_results] + [item for item in remainder_results]
+        if lazy:
+            from djax.models import AxilentContentRecord
+            search_results = content_client.search(query,self.model.ACE.content_type)
+            records = dict((record.axilent_content_key,record.local_id) for record in AxilentContentRecord.objects.filter(axilent_content_type=self.model.ACE.content_type,
+                                                                                                                           axilent_content_key__in=[result.key for result in search_results]))
+            local_ids = [records[result.key] for result in search_results if result.key in records]
+            queryset = queryset.annotate(search_rank=self._rank_expression([(local_id,rank) for rank, local_id in enumerate(local_ids)],len(local_ids)))
+            return self._order_by(queryset,'search_rank')
+        
+        search_results = self.search(query).filter(pk__in=queryset.values_list('pk',flat=True))
+        remainder_results = queryset.exclude(pk__in=search_results.values_list('pk',flat=True))
+        final_results = list(search_results) + list(remainder_results)
         return final_results
     
-    def freeze(self,results):
+    def _rank_expression(self,ranking,default):
+        """
+        Builds a database expression giving each pk in the ranking, a list of (pk, value)
+        tuples, its value.  Other rows get the default.
+        """
+        if Case is None:
+            raise ValueError('Sorting in the database requires Django 1.8 or later.')
+        
+        return Case(*[When(pk=pk,then=Value(value)) for pk, value in ranking],
+                    default=Value(default),
+                    output_field=IntegerField())
+    
+    def _order_by(self,queryset,*ordering):
+        """
+        Orders the queryset by the ordering, falling back to the queryset's own ordering.
+        """
+        existing_ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        return queryset.order_by(*(list(ordering) + existing_ordering))
+    
+    def freeze(self,results,compact=None):
         """
         Freezes the results, returning a frozen sort key. Results must be
-        endorsed content items from channel_sort.
+        endorsed content items from channel_sort.  See FrozenSortManager.freeze
+        for compact.
         """
         from djax.models import FrozenSort
-        return FrozenSort.objects.freeze(results)
+        return FrozenSort.objects.freeze(results,compact=compact)
     
-    def get_frozen_sort(self,key):
+    def get_frozen_sort(self,key,offset=0,limit=None):
         """
         Gets channels results from a frozen sort.  Will raise FrozenSort.DoesNotExist
-        if the key doesn't match any frozen sorts.
+        if the key doesn't match any frozen sorts.  Offset and limit select a page
+        of the results.
         """
         from djax.models import FrozenSort
         fs = FrozenSort.objects.get(key=key)
-        return fs.sorted_results()
+        return fs.sorted_results(offset=offset,limit=limit)
+
+class ContentFuture(object):
+    """
+    The pending result of an ACE call running on the shared pool.  Calling get waits
+    for the ACE call and then resolves its results to local models in the calling
+    thread.
+    """
+    def __init__(self,pending,resolve):
+        self.pending = pending
+        self.resolve = resolve
+        self.resolved = False
+        self.value = None
+    
+    def get(self,timeout=None):
+        """
+        Gets the resolved results.  Raises any exception raised by the ACE call.
+        """
+        if not self.resolved:
+            self.value = self.resolve(self.pending.get(timeout))
+            self.resolved = True
+        return self.value
 
 class ContentItemWrapper(object):
     """
@@ -29,13 +29,17 @@ if not hasattr(settings,'AXILENT_API_KEY') or not settings.AXILENT_API_KEY:
 
 _api_key = settings.AXILENT_API_KEY
 
+_max_connections = 10
+if hasattr(settings,'AXILENT_MAX_CONNECTIONS') and settings.AXILENT_MAX_CONNECTIONS:
+    _max_connections = settings.AXILENT_MAX_CONNECTIONS
+
 _library_api_key = settings.AXILENT_LIBRARY_API_KEY if hasattr(settings,'AXILENT_LIBRARY_API_KEY') else None
 
 # ===========
 # = Clients =
 # ===========
-cx = AxilentConnection(_api_key,_api_version,_endpoint)
-library_cx = AxilentConnection(_library_api_key,_api_version,_endpoint) if _library_api_key else None
+cx = AxilentConnection(_api_key,_api_version,_endpoint,max_connections=_max_connections)
+library_cx = AxilentConnection(_library_api_key,_api_version,_endpoint,max_connections=_max_connections) if _library_api_key else None
 
 content_client = ContentClient(cx)
 trigger_client = TriggerClient(cx)
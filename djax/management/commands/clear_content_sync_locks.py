@@ -9,9 +9,22 @@ class Command(BaseCommand):
     """
     Command class.
     """
+    option_list = BaseCommand.option_list + (
+        make_option('--expired',
+                    dest='expired',
+                    action='store_true',
+                    default=False,
+                    help='Only clear expired sync leases.  Expired leases are also taken over by the next sync.'),
+    )
+    
     def handle(self,**options):
         """
         Handler.
         """
-        for sync_lock in ContentSyncLock.objects.all():
+        if options.get('expired',False):
+            sync_locks = ContentSyncLock.objects.expired()
+        else:
+            sync_locks = ContentSyncLock.objects.all()
+        
+        for sync_lock in sync_locks:
             sync_lock.delete()
@@ -0,0 +1,27 @@
+"""
+Runs the Djax microbenchmarks.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from djax.benchmarks import benchmarks
+
+class Command(BaseCommand):
+    """
+    Command class.
+    """
+    args = '[benchmark ...]'
+    
+    def handle(self,*args,**options):
+        """
+        Handler method.
+        """
+        names = args or sorted(benchmarks.keys())
+        for name in names:
+            if not name in benchmarks:
+                raise CommandError('No such benchmark %s.  Choose from: %s' % (name,', '.join(sorted(benchmarks.keys()))))
+            
+            benchmark, headings = benchmarks[name]
+            print name
+            print '\t'.join(headings)
+            for row in benchmark():
+                print '\t'.join([('%.2f' % value) if isinstance(value,float) else str(value) for value in row])
+            print
@@ -0,0 +1,45 @@
+"""
+Syncs the content queued by the sync record webhook.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from djax.content import drain_sync_queue
+import time
+
+class Command(BaseCommand):
+    """
+    The command class.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--window',
+                    dest='window',
+                    type='float',
+                    default=None,
+                    help='Only sync items last queued at least this many seconds ago.'),
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Sync in batches of this many content keys.'),
+        make_option('--interval',
+                    dest='interval',
+                    type='float',
+                    default=None,
+                    help='Keep draining the queue, every this many seconds.'),
+    )
+    
+    def handle(self,*args,**options):
+        """
+        Handler method.
+        """
+        window = options.get('window',None)
+        batch_size = options.get('batch_size',None)
+        interval = options.get('interval',None)
+        
+        while True:
+            synced, failed = drain_sync_queue(window=window,batch_size=batch_size)
+            if synced or failed:
+                print 'Synced %d queued items, %d failed.' % (synced,failed)
+            if not interval:
+                break
+            time.sleep(interval)
@@ -1,9 +1,9 @@
 """
 Synchronizes the local model with Axilent.
 """
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
-from djax.content import sync_content
+from djax.content import sync_content, ContentSyncError
 
 class Command(BaseCommand):
     """
@@ -14,6 +14,21 @@ class Command(BaseCommand):
                     dest='content_type',
                     default=None,
                     help='The ACE content type to sync.  If not specified then all the ACE content will by synced.'),
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Sync in batches of this many content keys, using bulk calls to ACE.'),
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=None,
+                    help='Sync content types and key ranges concurrently on this many worker threads.'),
+        make_option('--full',
+                    dest='full',
+                    action='store_true',
+                    default=False,
+                    help='Check all of the content keys, rather than only the content changed since the last sync.'),
     )
     
     def handle(self,*args,**options):
@@ -22,11 +37,17 @@ class Command(BaseCommand):
         """
         print 'Syncing local models with ACE'
         content_type = options.get('content_type',None)
+        batch_size = options.get('batch_size',None)
+        workers = options.get('workers',None)
+        incremental = not options.get('full',False)
         result = None
-        if content_type:
-            result = sync_content(content_type_to_sync=content_type)
-        else:
-            result = sync_content()
+        try:
+            if content_type:
+                result = sync_content(content_type_to_sync=content_type,batch_size=batch_size,workers=workers,incremental=incremental)
+            else:
+                result = sync_content(batch_size=batch_size,workers=workers,incremental=incremental)
+        except ContentSyncError as cse:
+            raise CommandError('%d sync workers failed:\n%s' % (len(cse.errors),'\n'.join(['%s: %s' % (ctype,unicode(error)) for ctype, error in cse.errors])))
         if result:
             print 'Content model has been synced with ACE'
         else:
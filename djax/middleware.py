@@ -2,6 +2,7 @@
 Middleware for Djax
 """
 import re
+from django.conf import settings
 from djax import triggers
 import logging
 
@@ -9,26 +10,48 @@ log = logging.getLogger('djax')
 
 cookie_age = 60 * 60 * 24 * 365
 
+# ============
+# = Settings =
+# ============
+if hasattr(settings,'DJAX_TRIGGER_EXCLUDE_PATHS'):
+    exclude_paths = tuple(settings.DJAX_TRIGGER_EXCLUDE_PATHS)
+else:
+    # by default skip static and media files served by Django
+    exclude_paths = tuple([url for url in (getattr(settings,'STATIC_URL',None),getattr(settings,'MEDIA_URL',None)) if url and url.startswith('/')])
+
 class TriggerMiddleware(object):
     """ 
-    Middleware that applies triggermaps.
+    Middleware that applies triggermaps.  Requests whose paths start with one of
+    the DJAX_TRIGGER_EXCLUDE_PATHS prefixes are skipped entirely.
     """
+    def excluded(self,request):
+        """ 
+        Determines if the request path is excluded from the middleware.
+        """
+        return bool(exclude_paths) and request.path.startswith(exclude_paths)
+    
     def process_request(self,request):
         """ 
         Processes the http request.  Will fire triggers for matching request paths.
+        The profile is only resolved if a trigger matches.
         """
+        if self.excluded(request):
+            return None
+        
         # Ensure trigger mappings
         if not triggers.trigger_mappings:
             triggers.build_mappings()
         
+        matches = triggers.get_dispatcher().match(request.path[1:])
+        if not matches:
+            return None
+        
         # Get profile
         from djax.models import ProfileRecord
         pr, pr_created = ProfileRecord.objects.for_request(request)
         
-        for trigger in triggers.trigger_mappings:
-            mo = trigger.regex.match(request.path[1:])
-            if mo:
-                trigger.fire(mo.groupdict(),request,pr)
+        for trigger, mo in matches:
+            trigger.fire(mo.groupdict(),request,pr)
         
         if pr_created:
             request.session['axilent-profile'] = pr.profile
@@ -39,6 +62,9 @@ class TriggerMiddleware(object):
         """ 
         If a profile guid is found in the session, drop a cookie.
         """
+        if self.excluded(request):
+            return response
+        
         if 'axilent-profile' in request.session:
             profile = request.session['axilent-profile']
             response.set_cookie('axilent-profile',profile,max_age=cookie_age)
@@ -2,34 +2,163 @@
 Models for Djax.
 """
 from django.db import models, IntegrityError
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 import logging
-from datetime import datetime
+import hashlib
+import json
+from datetime import datetime, timedelta
 from djax.gateway import content_client, library_client, library_project, trigger_client
 from djax.registry import content_registry, build_registry
+import operator
 import re
 import threading
+import time
 import uuid
 from djax.triggers import build_mappings
+from djax.profiles import new_profile
+from djax.cache import record_cache
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
 
 log = logging.getLogger('djax')
 
+# ============
+# = Settings =
+# ============
+sync_lease_duration = settings.DJAX_SYNC_LEASE_DURATION if hasattr(settings,'DJAX_SYNC_LEASE_DURATION') else 300
+
+def fingerprint(data):
+    """
+    Gets a stable hash of a content data dictionary, used to tell if content has
+    changed since it was last pushed to ACE.
+    """
+    return hashlib.sha1(json.dumps(data,sort_keys=True,default=unicode)).hexdigest()
+
+class KeyLocks(object):
+    """
+    A lock per key.  Locks are created on first use and discarded when no thread
+    holds or waits for them.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.mutex = threading.Lock()
+    
+    def acquire(self,key):
+        with self.mutex:
+            lock, users = self.locks.get(key,(None,0))
+            if lock is None:
+                lock = threading.RLock()
+            self.locks[key] = (lock,users + 1)
+        lock.acquire()
+    
+    def release(self,key):
+        with self.mutex:
+            lock, users = self.locks[key]
+            lock.release()
+            if users > 1:
+                self.locks[key] = (lock,users - 1)
+            else:
+                del self.locks[key]
+    
+    def lock(self,key):
+        """
+        Context manager holding the lock for the key.
+        """
+        return _KeyLock(self,key)
+
+class _KeyLock(object):
+    def __init__(self,key_locks,key):
+        self.key_locks = key_locks
+        self.key = key
+    
+    def __enter__(self):
+        self.key_locks.acquire(self.key)
+    
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.key_locks.release(self.key)
+
 class AxilentContentRecordManager(models.Manager):
     """
     Manager class for AxilentContentRecord.
     """
     def __init__(self,*args,**kwargs):
         super(AxilentContentRecordManager,self).__init__(*args,**kwargs)
-        self.lock = threading.RLock()
+        self.locks = KeyLocks()
     
     def get_record(self,model):
         """
-        Gets the record for the specified model.
+        Gets the record for the specified model.  Uses the record cache if it is enabled.
         """
         content_type = ContentType.objects.get_for_model(model)
+        if record_cache:
+            record = record_cache.get_local(self.model,content_type.pk,model.pk)
+            if record is None:
+                record = self.get(local_content_type=content_type,local_id=model.pk)
+                record_cache.set(record)
+            return record
         return self.get(local_content_type=content_type,local_id=model.pk)
     
+    def get_by_content_key(self,axilent_content_type,axilent_content_key):
+        """
+        Gets the record for the specified ACE content item.  Uses the record cache if
+        it is enabled.
+        """
+        if record_cache:
+            record = record_cache.get_ace(self.model,axilent_content_type,axilent_content_key)
+            if record is None:
+                record = self.get(axilent_content_type=axilent_content_type,axilent_content_key=axilent_content_key)
+                record_cache.set(record)
+            return record
+        return self.get(axilent_content_type=axilent_content_type,axilent_content_key=axilent_content_key)
+    
+    def get_records(self,models):
+        """
+        Gets the records for several models with a single query.  Returns a dictionary
+        of (local content type id, local id) to record.  Models without records are
+        left out.
+        """
+        local_ids = {}
+        for model in models:
+            local_ids.setdefault(ContentType.objects.get_for_model(model).pk,set()).add(model.pk)
+        if not local_ids:
+            return {}
+        
+        query = reduce(operator.or_,[Q(local_content_type=content_type_id,local_id__in=ids) for content_type_id, ids in local_ids.items()])
+        return dict(((record.local_content_type_id,record.local_id),record) for record in self.filter(query))
+    
+    def get_by_content_keys(self,content_links):
+        """
+        Gets the records for several ACE content items with a single query, from an
+        iterable of (content type, content key) tuples.  Returns a dictionary of
+        (content type, content key) to record.  Content without records is left out.
+        """
+        keys_by_type = {}
+        for axilent_content_type, axilent_content_key in content_links:
+            keys_by_type.setdefault(axilent_content_type,set()).add(axilent_content_key)
+        if not keys_by_type:
+            return {}
+        
+        query = reduce(operator.or_,[Q(axilent_content_type=content_type,axilent_content_key__in=keys) for content_type, keys in keys_by_type.items()])
+        return dict(((record.axilent_content_type,record.axilent_content_key),record) for record in self.filter(query))
+    
+    def record_index(self,axilent_content_type,axilent_content_keys=None):
+        """
+        Loads the records for the ACE content type with a single query, limited to the
+        specified content keys if given.  Returns a dictionary of ACE content key to a
+        (local_id, updated) tuple.
+        """
+        records = self.filter(axilent_content_type=axilent_content_type)
+        if axilent_content_keys is not None:
+            records = records.filter(axilent_content_key__in=axilent_content_keys)
+        records = records.values_list('axilent_content_key','local_id','updated')
+        return dict((key,(local_id,updated)) for key, local_id, updated in records)
+    
     def field_map(self,model,axilent_content={}):
         """
         Gets the field map for the model.
@@ -53,82 +182,82 @@ class AxilentContentRecordManager(models.Manager):
         
         return field_map
     
-    def create_model(self,axilent_content_type,axilent_content_key):
+    def create_model(self,axilent_content_type,axilent_content_key,content_data=None):
         """
-        Creates a new model and accompaning content record for the axilent content.
+        Creates a new model and accompaning content record for the axilent content.  If the
+        content data has already been fetched from ACE it may be passed in as content_data.
         """
-        from djax.content import DefaultFieldConverter
+        from djax.content import FieldMapPlan, field_map_plan
         
         log.debug('Creating new model of content type:%s and key:%s.' % (axilent_content_type,axilent_content_key))
         
         build_registry() # ensure registry is built
-        content_data = content_client.get_content(axilent_content_type,axilent_content_key)
-        local_model, record = None, None
+        if content_data is None:
+            content_data = content_client.get_content(axilent_content_type,axilent_content_key)
         try:
             model_class = content_registry[axilent_content_type]
+        except KeyError:
+            raise ValueError('ACE content type %s cannot be found in the local registry.' % axilent_content_type)
         
-            field_map = {}
-            try:
-                field_map = model_class.ACE.field_map
-            except AttributeError:
-                for key in content_data.data.keys():
-                    field_map[key] = key
-            
-            # Iterate through the field map and set the local model values from the incoming Axilent content
-            fields = {}
-            deferred_field_converters = []
-            for axilent_field, model_field in field_map.items():
-                if hasattr(content_data,axilent_field):
-                    try:            
-                        if hasattr(model_field,'field'):
-                            log.debug('%s using field converter %s.' % (axilent_field,unicode(model_field)))
-                            # this is a field converter
-                            # sanity check
-                            if not hasattr(model_field,'to_ace') or not hasattr(model_field,'to_local_model'):
-                                raise ValueError('You must define the methods to_ace and to_local_model for field converter for ace field %s.' % axilent_field)
+        plan = field_map_plan(model_class)
+        if plan is None:
+            # Default the field map to the axilent fields
+            plan = FieldMapPlan(dict((key,key) for key in content_data.data.keys()))
+        
+        # Set the local model values from the incoming Axilent content
+        fields = plan.local_fields(content_data)
+        
+        try:
+            # the local model is rolled back with the record if the record can't be created
+            with atomic():
+                log.debug('Creating local model with field data %s.' % unicode(fields))
+                local_model = model_class.objects.create(**fields) # create the local model with the content data
                 
-                            if hasattr(model_field,'deferred') and model_field.deferred:
-                                log.debug('%s uses a deferred field converter.' % axilent_field)
-                                deferred_field_converters.append((axilent_field,model_field))
-                            else:
-                                log.debug('%s uses an immediate field converter.' % axilent_field)
-                                value = model_field.to_local_model(content_data,getattr(content_data,axilent_field))
-                                fields[model_field.field] = value
-                        else:
-                            log.debug('Using default field converter for %s.' % axilent_field)
-                            # not a field converter, just a string.  Use DefaultFieldConverter
-                            default_field_converter = DefaultFieldConverter(model_field)
-                            fields[model_field] = default_field_converter.to_local_model(content_data,getattr(content_data,axilent_field))
-                    except AttributeError:
-                        log.exception('Local model has no field %s (matched to Axilent field %s).' % (model_field,axilent_field))
+                if plan.deferred:
+                    plan.apply_deferred(content_data,local_model)
+                    local_model.save()
                 else:
-                    log.info('Skipping ace field %s - not in data from ace.' % axilent_field)
-            
-            log.debug('Creating local model with field data %s.' % unicode(fields))
-            local_model = model_class.objects.create(**fields) # create the local model with the content data
-            
-            if deferred_field_converters:
-                for deferred_axilent_field, deferred_model_field in deferred_field_converters:
-                    try:
-                        deferred_model_field.to_local_model(content_data,getattr(content_data,deferred_axilent_field),local_model)
-                    except AttributeError:
-                        log.exception('Local model has no field %s (matched to Axilent field %s).' % (deferred_model_field.field,deferred_axilent_field))
-            
-                local_model.save()
-            else:
-                log.info('No deferred field converters for %s.' % unicode(local_model))
-
-            local_content_type = ContentType.objects.get_for_model(local_model)
-            record = self.create(local_content_type=local_content_type,
-                                 local_id=local_model.pk,
-                                 axilent_content_type=axilent_content_type,
-                                 axilent_content_key=axilent_content_key,
-                                 updated=datetime.now())
-        except KeyError:
-            raise ValueError('ACE content type %s cannot be found in the local registry.' % axilent_content_type)
+                    log.info('No deferred field converters for %s.' % unicode(local_model))
+                
+                local_content_type = ContentType.objects.get_for_model(local_model)
+                record = self.create(local_content_type=local_content_type,
+                                     local_id=local_model.pk,
+                                     axilent_content_type=axilent_content_type,
+                                     axilent_content_key=axilent_content_key,
+                                     updated=datetime.now())
+        except IntegrityError:
+            # another sync worker may have created the content meanwhile, as when it is linked from two key ranges
+            existing = list(self.filter(axilent_content_type=axilent_content_type,axilent_content_key=axilent_content_key)[:1])
+            if not existing:
+                raise
+            record = existing[0]
+            log.info('Content %s:%s was created concurrently, using the existing record.' % (axilent_content_type,axilent_content_key))
+            local_model = record.get_local_model()
         
         return (local_model,record)
     
+    def local_models(self,records):
+        """
+        Gets the local models for the records, with one query per local model class.
+        Returns a dictionary of record id to local model.  Records whose local model
+        no longer exists are left out.
+        """
+        local_ids = {}
+        for record in records:
+            local_ids.setdefault(record.local_content_type_id,[]).append(record.local_id)
+        
+        models_by_type = {}
+        for local_content_type_id, ids in local_ids.items():
+            model_class = ContentType.objects.get_for_id(local_content_type_id).model_class()
+            models_by_type[local_content_type_id] = model_class.objects.in_bulk(ids)
+        
+        local_models = {}
+        for record in records:
+            local_model = models_by_type[record.local_content_type_id].get(record.local_id)
+            if local_model is not None:
+                local_models[record.pk] = local_model
+        return local_models
+    
     def get_or_create_model(self,axilent_content_type,axilent_content_key):
         """
         Gets the locally cached model, corresponding to the AxilentContentRecord, or,
@@ -136,8 +265,7 @@ class AxilentContentRecordManager(models.Manager):
         data in ACE.
         """
         try:
-            record = self.get(axilent_content_type=axilent_content_type,
-                              axilent_content_key=axilent_content_key)
+            record = self.get_by_content_key(axilent_content_type,axilent_content_key)
             return record.get_local_model()
         except AxilentContentRecord.DoesNotExist:
             local_model, record = self.create_model(axilent_content_type,axilent_content_key)
@@ -164,7 +292,7 @@ class AxilentContentRecordManager(models.Manager):
         """
         if re.match(r'^[\w\s]+:[A-Fa-f0-9]+$',value):
             ctype, ckey = value.split(':')
-            record = self.get(axilent_content_type=ctype,axilent_content_key=ckey)
+            record = self.get_by_content_key(ctype,ckey)
             return record.get_local_model()
         else:
             return value
@@ -183,24 +311,62 @@ class AxilentContentRecordManager(models.Manager):
         
         return lib_data
     
-    def push_to_library(self,model):
+    def update_record(self,record,**values):
+        """
+        Sets the values on the record, writing only those columns so that concurrent
+        changes to the record's other columns are kept.
+        """
+        for name, value in values.items():
+            setattr(record,name,value)
+        self.filter(pk=record.pk).update(**values)
+        if record_cache:
+            record_cache.invalidate(record) # update() sends no post_save
+    
+    def push_lock(self,model):
+        """
+        Gets the lock held while pushing the model, so that the model is not pushed
+        by two threads at once.
+        """
+        return self.locks.lock((ContentType.objects.get_for_model(model).pk,model.pk))
+    
+    def push_record(self,model,records=None):
+        """
+        Gets the record for a model being pushed, from records if supplied (as returned
+        by get_records) or else from the database.
+        """
+        if records:
+            record = records.get((ContentType.objects.get_for_model(model).pk,model.pk))
+            if record is not None:
+                return record
+        return self.get_record(model)
+    
+    def push_to_library(self,model,records=None,force=False):
         """
         Pushes the model to the Axilent library (assuming the library integration is active).
+        If the records of several models have been loaded with get_records they may be
+        passed in as records.  Content that has not changed since it was last pushed is
+        skipped, unless force is True.
         
         Returns a 2-tuple of booleans indicating 1.  If the library was updated and 2. If the
         content item was created on Axilent for the first time.
         
         """
         if library_client:
-            with self.lock:
-                lib_data = self.data_for_library(model)
+            lib_data = self.data_for_library(model)
+            lib_fingerprint = fingerprint(lib_data)
+            with self.push_lock(model):
                 try:
-                    record = self.get_record(model)
+                    record = self.push_record(model,records)
+                    if record.library_fingerprint == lib_fingerprint and not force:
+                        log.debug('Skipping library push of unchanged content %s:%s.' % (record.axilent_content_type,record.axilent_content_key))
+                        return (False,False)
+                    
                     # this content item already exists on Axilent - update
                     response = library_client.update_content(record.axilent_content_type,
                                                              library_project,
                                                              record.axilent_content_key,
                                                              **lib_data)
+                    self.update_record(record,library_fingerprint=lib_fingerprint)
                     return (True,False)
                 except AxilentContentRecord.DoesNotExist:
                     # this is new
@@ -215,28 +381,35 @@ class AxilentContentRecordManager(models.Manager):
                     self.create(local_content_type=local_content_type,
                                 local_id=model.pk,
                                 axilent_content_type=axilent_content_type,
-                                axilent_content_key=returned_key)
+                                axilent_content_key=returned_key,
+                                library_fingerprint=lib_fingerprint)
             
                     return (True,True)
 
         else:
             return (False,False)
     
-    def push_to_graphstack(self,model):
+    def push_to_graphstack(self,model,records=None,force=False):
         """
         Pushes the model to the graphstack associated with the content client.  Like push_to_library
         will return a 2-tuple, indicating (1) if the graphstack was updated and (2) if it was
-        created for the first time.
+        created for the first time, and skips unchanged content unless force is True.
         """
         if content_client:
-            with self.lock:
-                data = self.data_for_library(model)
+            data = self.data_for_library(model)
+            data_fingerprint = fingerprint(data)
+            with self.push_lock(model):
                 try:
-                    record = self.get_record(model)
+                    record = self.push_record(model,records)
+                    if record.graphstack_fingerprint == data_fingerprint and not force:
+                        log.debug('Skipping graphstack push of unchanged content %s:%s.' % (record.axilent_content_type,record.axilent_content_key))
+                        return (False,False)
+                    
                     # this content item exists in ACE, try to update
                     response = content_client.update_content(record.axilent_content_type,
                                                              record.axilent_content_key,
                                                              **data)
+                    self.update_record(record,graphstack_fingerprint=data_fingerprint)
                     return (True,False)
                 except AxilentContentRecord.DoesNotExist:
                     # new content
@@ -249,7 +422,8 @@ class AxilentContentRecordManager(models.Manager):
                     self.create(local_content_type=local_content_type,
                                 local_id=model.pk,
                                 axilent_content_type=axilent_content_type,
-                                axilent_content_key=response)
+                                axilent_content_key=response,
+                                graphstack_fingerprint=data_fingerprint)
             
                     return (True,True)
         else:
@@ -261,6 +435,13 @@ class AxilentContentRecordManager(models.Manager):
         """
         content_type = model_class.ACE.content_type
         search_results = content_client.search(query,content_type)
+        return self.search_results(model_class,search_results)
+    
+    def search_results(self,model_class,search_results):
+        """
+        Provides the model instances that match the search results from ACE.
+        """
+        content_type = model_class.ACE.content_type
         content_records = self.filter(axilent_content_type=content_type,axilent_content_key__in=[result.key for result in search_results])
         return model_class.objects.filter(pk__in=[record.local_id for record in content_records])
 
@@ -273,6 +454,8 @@ class AxilentContentRecord(models.Model):
     axilent_content_type = models.CharField(max_length=100)
     axilent_content_key = models.CharField(max_length=100)
     updated = models.DateTimeField(null=True)
+    library_fingerprint = models.CharField(max_length=40,null=True)
+    graphstack_fingerprint = models.CharField(max_length=40,null=True)
     
     objects = AxilentContentRecordManager()
     
@@ -299,60 +482,24 @@ class AxilentContentRecord(models.Model):
         """
         Syncs the local content to the incoming axilent content (a dictionary).
         """
-        from djax.content import DefaultFieldConverter
+        from djax.content import field_map_plan
         
         local_model = self.get_local_model()
-        field_map = local_model.ACE.field_map
-        
-        log.debug('syncing local model with Axilent content %s, using field map %s.' % (unicode(axilent_content),unicode(field_map)))
+        plan = field_map_plan(local_model.__class__)
         
-        # Iterate through the field map and set the local model values from the incoming Axilent content
-        deferred_field_converters = []
-        
-        for axilent_field, model_field in field_map.items():
-            if hasattr(model_field,'field'):
-                # this is a field converter
-                # sanity check
-                if not hasattr(model_field,'to_ace') or not hasattr(model_field,'to_local_model'):
-                    raise ValueError('You must define the methods to_ace and to_local_model for field converter for ace field %s.' % axilent_field)
-                
-                # check deferred
-                if hasattr(model_field,'deferred') and model_field.deferred:
-                    deferred_field_converters.append((axilent_field,model_field))
-                else:
-                    # check nullable
-                    if (hasattr(model_field,'accepts_null') and model_field.accepts_null) or hasattr(axilent_content,axilent_field):
-                        # this is a nullable field converter or a non-null value
-                        value = None
-                        if hasattr(axilent_content,axilent_field): # for non-null fields, use the supplied value
-                            value = model_field.to_local_model(axilent_content,getattr(axilent_content,axilent_field))
-                        setattr(local_model,model_field.field,value)
-                    else:
-                        log.info('Skipping non-nullable field %s - not in data from ACE.' % axilent_field)
-            else:
-                # just a string, use default field converter
-                if hasattr(axilent_content,axilent_field):
-                    default_field_converter = DefaultFieldConverter(model_field)
-                    setattr(local_model,model_field,default_field_converter.to_local_model(axilent_content,getattr(axilent_content,axilent_field)))
-                else:
-                    log.info('Skipping default field %s - not in data from ACE.' % axilent_field)
+        log.debug('syncing local model with Axilent content %s, using field map %s.' % (unicode(axilent_content),unicode(local_model.ACE.field_map)))
         
+        # Set the local model values from the incoming Axilent content
+        plan.apply(axilent_content,local_model)
         local_model.save()
         
-        if deferred_field_converters:
-            for deferred_axilent_field, deferred_model_field in deferred_field_converters:
-                try:
-                    deferred_model_field.to_local_model(axilent_content,getattr(axilent_content,deferred_axilent_field),local_model)
-                except AttributeError:
-                    log.exception('Local model has no field %s (matched to Axilent field %s).' % (deferred_model_field.field,deferred_axilent_field))
-            
+        if plan.deferred:
+            plan.apply_deferred(axilent_content,local_model)
             local_model.save()
         else:
             log.info('No deferred field converters for %s.' % unicode(local_model))
-            
-            
-        self.updated = datetime.now()
-        self.save()
+        
+        AxilentContentRecord.objects.update_record(self,updated=datetime.now())
         
         return local_model
     
@@ -411,11 +558,254 @@ class AxilentContentRecord(models.Model):
     class Meta:
         unique_together = (('local_content_type','local_id'),('axilent_content_type','axilent_content_key'))
 
+class ContentSyncLockManager(models.Manager):
+    """
+    Manager for sync locks.
+    """
+    def acquire(self,operation,content_type,token,duration=None):
+        """
+        Atomically acquires the lease on the operation for the content type, for duration
+        seconds.  An expired lease, or one already held with the same token, is taken
+        over.  Returns True if the lease was acquired.
+        """
+        now = datetime.now()
+        expires = now + timedelta(seconds=duration or sync_lease_duration)
+        try:
+            with atomic():
+                self.create(operation=operation,content_type=content_type,token=token,expires=expires)
+            return True
+        except IntegrityError:
+            # the lease exists, take it over if it has expired
+            taken = self.filter(Q(expires__lt=now) | Q(token=token),operation=operation,content_type=content_type).update(token=token,expires=expires)
+            return taken == 1
+    
+    def renew(self,operation,token,duration=None):
+        """
+        Extends all of the leases on the operation held with the token by duration
+        seconds from now, with one update.  Returns the number of leases renewed.
+        """
+        expires = datetime.now() + timedelta(seconds=duration or sync_lease_duration)
+        return self.filter(operation=operation,token=token).update(expires=expires)
+    
+    def held(self,operation,token):
+        """
+        Gets the content types whose leases on the operation are held with the token.
+        """
+        return list(self.filter(operation=operation,token=token).values_list('content_type',flat=True))
+    
+    def release(self,operation,token,content_type=None):
+        """
+        Releases the lease on the operation for the content type held with the token, or
+        all of the leases on the operation held with the token.
+        """
+        leases = self.filter(operation=operation,token=token)
+        if content_type is not None:
+            leases = leases.filter(content_type=content_type)
+        leases.delete()
+    
+    def expired(self):
+        """
+        Gets the expired leases.
+        """
+        return self.filter(expires__lt=datetime.now())
+
 class ContentSyncLock(models.Model):
     """
-    Lock for a content sync.  Indicates a sync is under way.
+    Lease on a sync operation ('content' or 'library') for an ACE content type.  The
+    lease is held by the sync with the token until it expires, and is kept alive by
+    renewing it while the sync is running.  An expired lease may be taken over by
+    another sync.
     """
+    operation = models.CharField(max_length=20,default='content')
+    content_type = models.CharField(max_length=100,default='')
     token = models.CharField(max_length=100)
+    expires = models.DateTimeField(null=True)
+    
+    objects = ContentSyncLockManager()
+    
+    class Meta:
+        unique_together = (('operation','content_type'),)
+
+class SyncLeases(object):
+    """
+    Holds the ContentSyncLock leases on an operation for several content types, taken
+    with one token.  A single heartbeat thread renews all of the leases together every
+    third of their duration, until they are released.  Leases may be acquired and
+    released one content type at a time while the heartbeat runs.  A lease that could not be
+    renewed is lost, as another sync may have taken it over, and the content type
+    should no longer be synced.  If the heartbeat fails it retries, and a lease it has
+    not renewed within its duration counts as lost.
+    """
+    def __init__(self,operation,token,duration=None):
+        self.operation = operation
+        self.token = token
+        self.duration = duration or sync_lease_duration
+        self.content_types = []
+        self.renewed = {} # content type to the time its lease was last renewed
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+    
+    def acquire(self,content_types):
+        """
+        Acquires the leases for the content types and starts the heartbeat if it is not
+        running.  Content types leased by another sync are left out.  Returns the list of
+        content types leased.
+        """
+        leased = []
+        for content_type in content_types:
+            requested = time.time()
+            if ContentSyncLock.objects.acquire(self.operation,content_type,self.token,self.duration):
+                with self.lock:
+                    self.content_types.append(content_type)
+                    self.renewed[content_type] = requested
+                    self.lost.discard(content_type)
+                leased.append(content_type)
+            else:
+                log.info('The %s sync of %s is locked by another sync, skipping it.' % (self.operation,content_type))
+        
+        if leased and self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.run,name='djax-sync-lease')
+            self.heartbeat.daemon = True
+            self.heartbeat.start()
+        return leased
+    
+    def held(self,content_type):
+        """
+        Determines if the lease for the content type is still held.
+        """
+        with self.lock:
+            if not content_type in self.content_types or content_type in self.lost:
+                return False
+            if time.time() - self.renewed[content_type] >= self.duration:
+                log.warning('The %s sync lease for %s has expired without being renewed.' % (self.operation,content_type))
+                self.lost.add(content_type)
+                return False
+            return True
+    
+    def run(self):
+        """
+        Heartbeat thread loop.
+        """
+        from django.db import connection
+        try:
+            while not self.stopped.wait(self.duration / 3.0):
+                try:
+                    self.renew()
+                except Exception:
+                    # retry on the next beat, with a new connection
+                    log.exception('Failed to renew the %s sync leases.' % self.operation)
+                    connection.close()
+        finally:
+            connection.close()
+    
+    def renew(self):
+        """
+        Renews the leases, noting any that have been lost.
+        """
+        with self.lock:
+            expected = [content_type for content_type in self.content_types if not content_type in self.lost]
+        
+        requested = time.time()
+        renewed = ContentSyncLock.objects.renew(self.operation,self.token,self.duration)
+        held = expected
+        if renewed < len(expected):
+            held = set(ContentSyncLock.objects.held(self.operation,self.token))
+        
+        with self.lock:
+            for content_type in expected:
+                if not content_type in self.content_types:
+                    continue # released meanwhile
+                if content_type in held:
+                    self.renewed[content_type] = requested
+                elif not content_type in self.lost:
+                    log.warning('Lost the %s sync lease for %s.' % (self.operation,content_type))
+                    self.lost.add(content_type)
+    
+    def release(self,content_types=None):
+        """
+        Releases the leases for the content types.  Without content types, stops the
+        heartbeat and releases all of the leases.
+        """
+        if content_types is None:
+            self.stopped.set()
+            if self.heartbeat:
+                self.heartbeat.join()
+            ContentSyncLock.objects.release(self.operation,self.token)
+            return
+        
+        for content_type in content_types:
+            with self.lock:
+                if content_type in self.content_types:
+                    self.content_types.remove(content_type)
+                self.renewed.pop(content_type,None)
+                self.lost.discard(content_type)
+            ContentSyncLock.objects.release(self.operation,self.token,content_type)
+
+class ContentSyncWatermarkManager(models.Manager):
+    """
+    Manager for content sync watermarks.
+    """
+    def advance(self,content_type,synced_at,cursor=None):
+        """
+        Records a successful sync of the content type.
+        """
+        watermark, created = self.get_or_create(content_type=content_type)
+        watermark.synced_at = synced_at
+        watermark.cursor = cursor
+        watermark.save()
+        return watermark
+
+class ContentSyncWatermark(models.Model):
+    """
+    High-water mark for a content type: the start time and ACE cursor of the last
+    successful sync.  An incremental sync only syncs the content changed since.
+    """
+    content_type = models.CharField(max_length=100,unique=True)
+    synced_at = models.DateTimeField(null=True)
+    cursor = models.CharField(max_length=255,null=True)
+    
+    objects = ContentSyncWatermarkManager()
+
+class PendingContentSyncManager(models.Manager):
+    """
+    Manager for the content sync queue.
+    """
+    def enqueue(self,axilent_content_type,axilent_content_key):
+        """
+        Queues a sync of the ACE content item.  A sync already queued for the item is
+        coalesced with this one.  Returns True if the item was newly queued.
+        """
+        now = datetime.now()
+        try:
+            with atomic():
+                self.create(axilent_content_type=axilent_content_type,axilent_content_key=axilent_content_key,requested=now)
+            return True
+        except IntegrityError:
+            self.filter(axilent_content_type=axilent_content_type,axilent_content_key=axilent_content_key).update(requested=now)
+            return False
+    
+    def due(self,window=0):
+        """
+        Gets the queued syncs last requested at least window seconds ago, oldest first.
+        """
+        return self.filter(requested__lte=datetime.now() - timedelta(seconds=window)).order_by('requested')
+
+class PendingContentSync(models.Model):
+    """
+    A queued sync of an ACE content item, requested by ACE through the sync record
+    webhook.  Repeated requests for the same item are coalesced into one entry.
+    """
+    axilent_content_type = models.CharField(max_length=100)
+    axilent_content_key = models.CharField(max_length=100)
+    requested = models.DateTimeField()
+    attempts = models.IntegerField(default=0)
+    
+    objects = PendingContentSyncManager()
+    
+    class Meta:
+        unique_together = (('axilent_content_type','axilent_content_key'),)
 
 class ProfileRecordManager(models.Manager):
     """
@@ -431,7 +821,7 @@ class ProfileRecordManager(models.Manager):
         try:
             return (self.get(user=user).profile,False)
         except ProfileRecord.DoesNotExist:
-            profile = trigger_client.profile()
+            profile = new_profile()
             record = self.create(user=user,profile=profile)
             return (record.profile,True)
     
@@ -451,7 +841,7 @@ class ProfileRecordManager(models.Manager):
         if profile:
             return self.get_or_create(profile=profile)
         else:
-            profile_record = self.create(profile=trigger_client.profile())
+            profile_record = self.create(profile=new_profile())
             return (profile_record,True)
 
 class ProfileRecord(models.Model):
@@ -489,42 +879,87 @@ class AuthToken(models.Model):
     def __unicode__(self):
         return self.token
 
+frozen_sort_compact = settings.DJAX_FROZEN_SORT_COMPACT if hasattr(settings,'DJAX_FROZEN_SORT_COMPACT') else False
+
 class FrozenSortManager(models.Manager):
     """
     Manager class for frozen sort.
     """
-    def freeze(self,results):
+    def freeze(self,results,compact=None):
         """
         Creates a new frozen sort.  Returns the key of the newly created frozen sort.
+        
+        The records for the results are resolved with a single query.  If compact is
+        true (defaulting to the DJAX_FROZEN_SORT_COMPACT setting) the ordered record
+        ids and rlevels are packed into the frozen sort row, rather than stored as one
+        FrozenSortElement per result.
         """
-        fs = self.create(key=uuid.uuid4().hex,created=datetime.now())
-        order = 0
+        if compact is None:
+            compact = frozen_sort_compact
+        
+        results = list(results)
+        records = AxilentContentRecord.objects.get_records([result.item for result in results])
+        elements = []
         for result in results:
-            FrozenSortElement.objects.create(frozen_sort=fs,
-                                             order=order,
-                                             content=AxilentContentRecord.objects.get_record(result.item),
-                                             rlevel=result.rlevel)
-            order += 1
+            try:
+                record = records[(ContentType.objects.get_for_model(result.item).pk,result.item.pk)]
+            except KeyError:
+                raise AxilentContentRecord.DoesNotExist('No content record for %s.' % unicode(result.item))
+            elements.append((record.pk,result.rlevel))
+        
+        if compact:
+            fs = self.create(key=uuid.uuid4().hex,created=datetime.now(),packed_elements=pack_elements(elements))
+        else:
+            fs = self.create(key=uuid.uuid4().hex,created=datetime.now())
+            FrozenSortElement.objects.bulk_create([FrozenSortElement(frozen_sort=fs,order=order,content_id=record_id,rlevel=rlevel)
+                                                   for order, (record_id, rlevel) in enumerate(elements)])
         return fs.key
 
+def pack_elements(elements):
+    """
+    Packs a list of (record id, rlevel) tuples into a string.
+    """
+    return ','.join(['%d:%d' % (record_id,rlevel) for record_id, rlevel in elements])
+
+def unpack_elements(packed):
+    """
+    Unpacks a string packed by pack_elements.
+    """
+    if not packed:
+        return []
+    return [tuple(map(int,element.split(':'))) for element in packed.split(',')]
+
 class FrozenSort(models.Model):
     """
     For freezing the results of a channel sort.
     """
     key = models.CharField(max_length=100)
     created = models.DateTimeField()
+    packed_elements = models.TextField(null=True)
     
     objects = FrozenSortManager()
     
     def __unicode__(self):
         return u'%s:%s' % (self.key,unicode(self.created))
         
-    def sorted_results(self):
+    def sorted_results(self,offset=0,limit=None):
         """
-        Returns a list of ContentItemWrappers.
+        Returns a list of ContentItemWrappers.  Offset and limit select a slice of
+        the results, for pagination.  The records are loaded with one query and the
+        local models with one query per content type.
         """
         from djax.content import ContentItemWrapper
-        return [ContentItemWrapper(element.local_model(),element.rlevel) for element in self.elements.all()]
+        end = offset + limit if limit is not None else None
+        
+        if self.packed_elements is not None:
+            packed = unpack_elements(self.packed_elements)[offset:end]
+            records = AxilentContentRecord.objects.in_bulk([record_id for record_id, rlevel in packed])
+            elements = [(records[record_id],rlevel) for record_id, rlevel in packed if record_id in records]
+        else:
+            elements = [(element.content,element.rlevel) for element in self.elements.select_related('content')[offset:end]]
+        
+        local_models = AxilentContentRecord.objects.local_models([record for record, rlevel in elements])
+        return [ContentItemWrapper(local_models[record.pk],rlevel) for record, rlevel in elements if record.pk in local_models]
 
 class FrozenSortElement(models.Model):
     """
@@ -546,6 +981,19 @@ class FrozenSortElement(models.Model):
         ordering = ['order']
 
 
+# ======================
+# = Record Cache Hooks =
+# ======================
+def invalidate_cached_record(sender,instance,**kwargs):
+    """
+    Removes a saved or deleted record from the record cache.
+    """
+    record_cache.invalidate(instance)
+
+if record_cache:
+    post_save.connect(invalidate_cached_record,sender=AxilentContentRecord)
+    post_delete.connect(invalidate_cached_record,sender=AxilentContentRecord)
+
 # =================
 # = Registry Hook =
 # =================
@@ -0,0 +1,188 @@
+"""
+In-process outbox for triggers.  Triggers are queued by the request and sent to
+ACE in batches by a background sender thread.
+"""
+from django.conf import settings
+from djax.gateway import trigger_client
+import Queue
+import atexit
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('djax')
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+class TriggerOutbox(object):
+    """
+    A bounded queue of triggers, drained by a sender thread that sends the triggers
+    in batches of up to batch_size, waiting at most interval seconds to fill a batch.
+
+    When the queue is full the policy decides what happens to a new trigger:
+    BLOCK waits up to block_timeout seconds for room (applying backpressure to the
+    request) and then drops it, DROP_NEWEST drops it and DROP_OLDEST drops the oldest
+    queued trigger to make room for it.
+    """
+    def __init__(self,client,max_size=10000,batch_size=100,interval=1.0,policy=DROP_NEWEST,block_timeout=0.05):
+        if not policy in (BLOCK,DROP_NEWEST,DROP_OLDEST):
+            raise ValueError('Unknown trigger outbox policy %s.' % policy)
+
+        self.client = client
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.max_size = max_size
+        self.queue = Queue.Queue(max_size)
+        self.send_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.sender = None
+        self.sender_pid = None
+        self.pid = os.getpid()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def enqueue(self,category,action,profile=None,variables={},environment={},identity={}):
+        """
+        Queues a trigger.  Returns True if the trigger was queued, False if it was dropped.
+        """
+        self.ensure_sender()
+        event = {'category':category,
+                 'action':action,
+                 'profile':profile,
+                 'variables':variables,
+                 'environment':environment,
+                 'identity':identity}
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except Queue.Full:
+            pass
+
+        if self.policy == BLOCK:
+            try:
+                self.queue.put(event,timeout=self.block_timeout)
+                return True
+            except Queue.Full:
+                pass
+        elif self.policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                self.queue.put_nowait(event)
+                return True
+            except (Queue.Empty,Queue.Full):
+                pass
+
+        self.dropped += 1
+        log.warn('Trigger outbox full, dropped trigger %s:%s.' % (category,action))
+        return False
+
+    def check_pid(self):
+        """
+        Gives a forked process a new, empty queue.  The triggers queued before the fork
+        are the parent's to send, and the queue's locks may have been copied while held.
+        """
+        if self.pid == os.getpid():
+            return
+
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue(self.max_size)
+                self.send_lock = threading.Lock()
+                self.pid = os.getpid()
+
+    def ensure_sender(self):
+        """
+        Starts the sender thread if it is not running in this process.  Threads do not
+        survive a fork, so a forked worker process starts its own sender.
+        """
+        if self.sender_pid == os.getpid():
+            return
+
+        self.check_pid()
+        with self.start_lock:
+            if self.sender_pid != os.getpid():
+                self.sender = threading.Thread(target=self.run,name='djax-trigger-outbox')
+                self.sender.daemon = True
+                self.sender.start()
+                self.sender_pid = os.getpid()
+
+    def run(self):
+        """
+        Sender thread loop.
+        """
+        while True:
+            batch = [self.queue.get()]
+            # hold the send lock while the batch fills, so a flush waits for it to be sent
+            with self.send_lock:
+                deadline = time.time() + self.interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except Queue.Empty:
+                        break
+
+                self.send(batch)
+
+    def send(self,batch):
+        """
+        Sends a batch of triggers to ACE.
+        """
+        try:
+            self.client.trigger_batch(batch)
+            self.sent += len(batch)
+            log.debug('Sent batch of %d triggers.' % len(batch))
+        except Exception:
+            self.failed += len(batch)
+            log.exception('Failed to send batch of %d triggers.' % len(batch))
+
+    def flush(self):
+        """
+        Sends all of the queued triggers from the calling thread, after any batch the
+        sender thread is filling or sending.  A forked process that queued nothing of its
+        own sends nothing: the inherited queue is discarded.
+        """
+        self.check_pid()
+        with self.send_lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+                if len(batch) >= self.batch_size:
+                    self.send(batch)
+                    batch = []
+            if batch:
+                self.send(batch)
+
+def build_trigger_outbox():
+    """
+    Builds the trigger outbox from the settings, or returns None if the outbox is
+    not enabled.
+    """
+    if not hasattr(settings,'DJAX_TRIGGER_OUTBOX') or not settings.DJAX_TRIGGER_OUTBOX:
+        return None
+
+    options = settings.DJAX_TRIGGER_OUTBOX_OPTIONS if hasattr(settings,'DJAX_TRIGGER_OUTBOX_OPTIONS') else {}
+    outbox = TriggerOutbox(trigger_client,**options)
+    atexit.register(outbox.flush) # flush on shutdown
+    return outbox
+
+trigger_outbox = build_trigger_outbox()
+
+def flush_trigger_outbox():
+    """
+    Sends any queued triggers.  May be called from server shutdown hooks.
+    """
+    if trigger_outbox:
+        trigger_outbox.flush()
@@ -0,0 +1,103 @@
+"""
+Pool of ACE profiles for new visitors.  Profiles are fetched from ACE ahead of time
+by a background refiller, so that new visitors don't wait on ACE for a profile.
+"""
+from django.conf import settings
+from djax.gateway import trigger_client
+from collections import deque
+import logging
+import os
+import threading
+
+log = logging.getLogger('djax')
+
+class ProfilePool(object):
+    """
+    A pool of unused ACE profiles.  When the pool falls below the low watermark a
+    background thread refills it up to the high watermark.  If the pool is empty a
+    profile is fetched from ACE synchronously.
+    """
+    def __init__(self,client,low=10,high=50):
+        if low > high:
+            raise ValueError('The profile pool low watermark must not exceed the high watermark.')
+
+        self.client = client
+        self.low = low
+        self.high = high
+        self.profiles = deque()
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.pid = os.getpid()
+
+    def profile(self):
+        """
+        Takes a profile from the pool.
+        """
+        self.check_pid()
+        try:
+            profile = self.profiles.popleft()
+        except IndexError:
+            profile = None
+
+        if len(self.profiles) < self.low:
+            self.refill()
+
+        if profile is None:
+            log.debug('Profile pool empty, fetching profile from ACE.')
+            return self.client.profile()
+        return profile
+
+    def check_pid(self):
+        """
+        Empties the pool in a forked process, so that no profile is handed out by two
+        processes.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.profiles = deque()
+                    self.refilling = False
+                    self.pid = os.getpid()
+
+    def refill(self):
+        """
+        Starts the background refiller, unless it is already running.
+        """
+        with self.lock:
+            if self.refilling:
+                return
+            self.refilling = True
+
+        def run():
+            try:
+                while len(self.profiles) < self.high:
+                    self.profiles.append(self.client.profile())
+                log.debug('Refilled profile pool to %d profiles.' % len(self.profiles))
+            except Exception:
+                log.exception('Failed to refill the profile pool.')
+            finally:
+                self.refilling = False
+
+        thread = threading.Thread(target=run,name='djax-profile-pool')
+        thread.daemon = True
+        thread.start()
+
+def build_profile_pool():
+    """
+    Builds the profile pool from the settings, or returns None if the pool is not enabled.
+    """
+    if not hasattr(settings,'DJAX_PROFILE_POOL') or not settings.DJAX_PROFILE_POOL:
+        return None
+
+    options = settings.DJAX_PROFILE_POOL_OPTIONS if hasattr(settings,'DJAX_PROFILE_POOL_OPTIONS') else {}
+    return ProfilePool(trigger_client,**options)
+
+profile_pool = build_profile_pool()
+
+def new_profile():
+    """
+    Gets a new ACE profile, from the pool if it is enabled.
+    """
+    if profile_pool:
+        return profile_pool.profile()
+    return trigger_client.profile()
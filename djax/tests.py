@@ -0,0 +1,112 @@
+"""
+Tests for Djax.  Run with "manage.py test djax".
+"""
+from django.db import models
+from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from datetime import datetime
+from djax.cache import ChannelRanking
+from djax.content import ACEContent, ContentChannel
+from djax.models import AxilentContentRecord
+
+# ===============
+# = Test Models =
+# ===============
+class ChannelTestArticle(models.Model,ACEContent):
+    """
+    Local content model for the tests.
+    """
+    title = models.CharField(max_length=100)
+
+    class ACE:
+        content_type = 'Channel Test Article'
+        field_map = {'title':'title'}
+
+    class Meta:
+        app_label = 'djax'
+
+class ChannelTestAuthor(models.Model,ACEContent):
+    """
+    A second local content model for the tests.
+    """
+    title = models.CharField(max_length=100)
+
+    class ACE:
+        content_type = 'Channel Test Author'
+        field_map = {'title':'title'}
+
+    class Meta:
+        app_label = 'djax'
+
+# ====================
+# = Content Channels =
+# ====================
+class ContentChannelQueryTest(TestCase):
+    """
+    Resolving content channel items to local models takes a constant number of queries,
+    however many items the channel returns.
+    """
+    def setUp(self):
+        # warm the content type cache, so that the counts only include the resolution queries
+        for model_class in (ChannelTestArticle,ChannelTestAuthor):
+            ContentType.objects.get_for_model(model_class)
+
+    def create_content(self,model_class,count):
+        """
+        Creates count local models with records.  Returns the matching channel items,
+        in the reverse of the order the models were created in.
+        """
+        content_type = ContentType.objects.get_for_model(model_class)
+        items = []
+        for i in range(count):
+            model = model_class.objects.create(title='%s %d' % (model_class.ACE.content_type,i))
+            key = '%x%04x' % (content_type.pk,i)
+            AxilentContentRecord.objects.create(local_content_type=content_type,
+                                                local_id=model.pk,
+                                                axilent_content_type=model_class.ACE.content_type,
+                                                axilent_content_key=key,
+                                                updated=datetime.now())
+            items.append(ChannelRanking(model_class.ACE.content_type,key,i))
+        items.reverse()
+        return items
+
+    def channel(self,items):
+        """
+        Gets a content channel returning the items, without calling ACE.
+        """
+        channel = ContentChannel('test-channel')
+        channel.fetch = lambda **params: items
+        return channel
+
+    def assert_channel_queries(self,model_class,count):
+        items = self.create_content(model_class,count)
+        channel = self.channel(items)
+
+        # one record query and one in_bulk query
+        with self.assertNumQueries(2):
+            results = channel.get_content(model_class.objects.all(),include_endorsements=True)
+
+        self.assertEqual([result.title for result in results],['%s %d' % (model_class.ACE.content_type,item.endorsement) for item in items])
+        self.assertEqual([result.rlevel for result in results],[item.endorsement for item in items])
+
+    def test_single_item(self):
+        self.assert_channel_queries(ChannelTestArticle,1)
+
+    def test_fifty_items(self):
+        self.assert_channel_queries(ChannelTestArticle,50)
+
+    def test_model_classes(self):
+        self.assert_channel_queries(ChannelTestArticle,50)
+        self.assert_channel_queries(ChannelTestAuthor,50)
+
+    def test_local_models_per_class(self):
+        self.create_content(ChannelTestArticle,50)
+        self.create_content(ChannelTestAuthor,50)
+        records = list(AxilentContentRecord.objects.all())
+
+        # one in_bulk query for each local model class
+        with self.assertNumQueries(2):
+            local_models = AxilentContentRecord.objects.local_models(records)
+
+        self.assertEqual(len(local_models),100)
+        self.assertEqual(set([local_model.__class__ for local_model in local_models.values()]),set([ChannelTestArticle,ChannelTestAuthor]))
@@ -4,11 +4,13 @@ Trigger functionality for Djax.
 from django.conf import settings
 import re
 from djax.gateway import trigger_client
+from djax.outbox import trigger_outbox
 import logging
 
 log = logging.getLogger('djax')
 
 trigger_mappings = []
+_dispatcher = None
 
 def get_module(module_name):
     """
@@ -47,6 +49,89 @@ def import_triggers(trigger_list):
         else:
             log.warn('Skipping non trigger item %s in trigger list.' % unicode(trigger_item))
 
+def get_dispatcher():
+    """ 
+    Gets the dispatcher for the trigger mappings, compiling it if the mappings have
+    changed since it was last compiled.
+    """
+    global _dispatcher
+    if _dispatcher is None or _dispatcher.size != len(trigger_mappings):
+        _dispatcher = TriggerDispatcher(trigger_mappings)
+    return _dispatcher
+
+_special_chars = set('.^$*+?{}[]()|\\')
+
+def literal_prefix(pattern):
+    """ 
+    Gets the literal text that any path matching the pattern must start with.  The
+    prefix is conservative: it is empty whenever the pattern is too complex to analyze.
+    """
+    if '|' in pattern:
+        return '' # alternation, matches may start with any branch
+    
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                literal, step = pattern[i + 1], 2 # escaped punctuation
+            else:
+                break # character class or special escape
+        elif char in _special_chars:
+            break
+        else:
+            literal, step = char, 1
+        
+        if pattern[i + step:i + step + 1] in ('?','*','{'):
+            break # literal may be absent
+        prefix.append(literal)
+        i += step
+    
+    return ''.join(prefix)
+
+class TriggerDispatcher(object):
+    """ 
+    Matches request paths against a list of triggers.  The triggers are indexed in a
+    trie by the literal prefix of their patterns, so only the triggers whose prefix
+    the path starts with have their regexes run.
+    """
+    def __init__(self,triggers):
+        self.size = len(triggers)
+        self.root = ({},[])
+        for order, trigger in enumerate(triggers):
+            prefix = '' if trigger.regex.flags & re.IGNORECASE else literal_prefix(trigger.regex.pattern)
+            children, node_triggers = self.root
+            for char in prefix:
+                children, node_triggers = children.setdefault(char,({},[]))
+            node_triggers.append((order,trigger))
+    
+    def candidates(self,path):
+        """ 
+        Gets the triggers that may match the path, in mapping order.
+        """
+        children, candidates = self.root
+        candidates = list(candidates)
+        for char in path:
+            if not char in children:
+                break
+            children, node_triggers = children[char]
+            candidates.extend(node_triggers)
+        
+        candidates.sort()
+        return [trigger for order, trigger in candidates]
+    
+    def match(self,path):
+        """ 
+        Gets a list of (trigger, match object) tuples for the triggers matching the path.
+        """
+        matches = []
+        for trigger in self.candidates(path):
+            mo = trigger.regex.match(path)
+            if mo:
+                matches.append((trigger,mo))
+        return matches
+
 class Trigger(object):
     """ 
     A trigger object.
@@ -85,7 +170,9 @@ class Trigger(object):
         from djax.models import ProfileRecord
         if not profile:
             profile, profile_created = ProfileRecord.objects.for_request(request)
-        if hasattr(settings,'DJAX_TRIGGER_ASYNC') and settings.DJAX_TRIGGER_ASYNC:
+        if trigger_outbox:
+            trigger_outbox.enqueue(self.category,self.action,profile=profile.profile,variables=self.build_var_dict(params))
+        elif hasattr(settings,'DJAX_TRIGGER_ASYNC') and settings.DJAX_TRIGGER_ASYNC:
             from djax.tasks import trigger_async
             trigger_async.delay(self,profile.profile,self.build_var_dict(params))
         else:
@@ -1,10 +1,11 @@
 """
 Views for Djax.
 """
-from djax.content import sync_content, sync_record, sync_library
+from djax.content import sync_content, sync_record, sync_library, sync_queue
 from django.http import HttpResponse
 import base64
-from djax.models import AuthToken
+from djax.models import AuthToken, PendingContentSync
+from djax.registry import content_registry, build_registry
 from django.conf import settings
 
 def check_auth(view):
@@ -50,11 +51,19 @@ def refresh_library(request,token=None):
 @check_auth
 def sync_record_view(request):
     """
-    Syncs a single record.
+    Syncs a single record.  If the sync queue is enabled the sync is queued, to be
+    run by drain_sync_queue.
     """
     content_type = request.GET.get('content_type',None)
     content_key = request.GET.get('content_key',None)
     if content_type and content_key:
+        if sync_queue:
+            build_registry()
+            if not content_type in content_registry:
+                return HttpResponse('ACE content type %s cannot be found in the local registry.' % content_type,status=409)
+            PendingContentSync.objects.enqueue(content_type,content_key)
+            return HttpResponse('Queued %s:%s' % (content_type,content_key),status=202)
+        
         try:
             if sync_record(content_type,content_key):
                 return HttpResponse('Created %s:%s' % (content_type,content_key),status=201)
@@ -1,28 +1,180 @@
 """
 Main client setup for Pax.
 """
-from sharrock.client import HttpClient, ResourceClient, ServiceException
+from sharrock.client import HttpClient, ResourceClient, ServiceException, HttpService, ResourceOperation
+from requests.adapters import HTTPAdapter
+import requests
+import threading
+import json
 import logging
 
 log = logging.getLogger('axilent-pax')
 
+class PooledTransport(object):
+    """
+    HTTP transport shared by the clients of a connection.  Connections are kept alive
+    and pooled, with at most max_connections open connections per host.  Callers block
+    when all of a host's connections are in use.  Safe to use from multiple threads.
+    """
+    def __init__(self,max_connections=10,max_hosts=10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_hosts,pool_maxsize=max_connections,pool_block=True)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self.adapter = adapter
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def request(self,method,url,**kwargs):
+        """
+        Makes a request over a pooled connection.
+        """
+        with self.lock:
+            self.requests += 1
+        try:
+            return self.session.request(method,url,**kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.failures += 1
+            raise
+
+    def stats(self):
+        """
+        Gets the pool statistics: the number of requests made and failed, and for each
+        host the number of connections opened and requests made over them.
+        """
+        hosts = {}
+        for host_key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[host_key]
+            hosts['%s://%s:%s' % (pool.scheme,pool.host,pool.port)] = {'connections':pool.num_connections,
+                                                                       'requests':pool.num_requests}
+        return {'requests':self.requests,
+                'failures':self.failures,
+                'hosts':hosts}
+
+class PooledHttpService(HttpService):
+    """
+    Sharrock service that makes its calls over the pooled transport.
+    """
+    def __init__(self,transport,*args,**kwargs):
+        super(PooledHttpService,self).__init__(*args,**kwargs)
+        self.transport = transport
+
+    def do_get(self,params):
+        response = self.transport.request('GET','%s/%s.json' % (self.service_url,self.descriptor['slug']),
+                                          params=params,
+                                          auth=(self.user,self.password))
+        return self.process_response(response)
+
+    def do_post(self,data=None,params={}):
+        if data and params:
+            raise ValueError('Either data or params can be submitted to be the POST body, but not both.')
+
+        response = self.transport.request('POST','%s/%s.json' % (self.service_url,self.descriptor['slug']),
+                                          data=json.dumps(data) if data else params,
+                                          auth=(self.user,self.password))
+        return self.process_response(response)
+
+class PooledHttpClient(HttpClient):
+    """
+    Sharrock HTTP client that makes its calls over the pooled transport.
+    """
+    def __init__(self,transport,*args,**kwargs):
+        super(PooledHttpClient,self).__init__(*args,**kwargs)
+        self.transport = transport
+
+    def _cache_descriptor(self,descriptor_name,force=False):
+        if not descriptor_name in self._services or force:
+            response = self.transport.request('GET','%s/describe/%s/%s/%s.json' % (self._service_url,self._app,self._version,descriptor_name))
+            self._services[descriptor_name] = PooledHttpService(self.transport,
+                                                                self._service_url,
+                                                                self._app,
+                                                                self._version,
+                                                                response.json(strict=False),
+                                                                auth_user=self.user,
+                                                                auth_password=self.password)
+
+class PooledResourceOperation(ResourceOperation):
+    """
+    Sharrock resource operation that makes its calls over the pooled transport.
+    """
+    def __init__(self,transport,*args,**kwargs):
+        super(PooledResourceOperation,self).__init__(*args,**kwargs)
+        self.transport = transport
+
+    def __call__(self,data=None,params=None,local_params_check=True):
+        if data and params:
+            raise ValueError('Either data or params can be submitted, but not both.')
+
+        if local_params_check:
+            self.check_params(data if data else params)
+
+        if data and self.http_method in ('POST','PUT'):
+            response = self.transport.request(self.http_method,self._url(),data=json.dumps(data),auth=(self.user,self.password))
+        else:
+            response = self.transport.request(self.http_method,self._url(),params=params,auth=(self.user,self.password))
+
+        return self.process_response(response)
+
+class PooledResourceClient(ResourceClient):
+    """
+    Sharrock resource client that makes its calls over the pooled transport.
+    """
+    def __init__(self,transport,*args,**kwargs):
+        self.transport = transport # needed by _cache_descriptor, called by the constructor
+        super(PooledResourceClient,self).__init__(*args,**kwargs)
+
+    def _cache_descriptor(self,force=False):
+        if not self._descriptor or force:
+            response = self.transport.request('GET','%s/describe/%s/%s/%s.json' % (self._service_url,self._app,self._version,self._resource_slug))
+            self._descriptor = response.json(strict=False)
+
+            for http_method in ('get','post','put','delete'):
+                if http_method in self._descriptor:
+                    setattr(self,http_method,PooledResourceOperation(self.transport,
+                                                                     self._service_url,
+                                                                     self._app,
+                                                                     self._version,
+                                                                     self._resource_slug,
+                                                                     self._descriptor[http_method],
+                                                                     http_method.upper(),
+                                                                     auth_user=self.user,
+                                                                     auth_password=self.password))
+
 class AxilentConnection(object):
     """
-    A connection with Axilent.
+    A connection with Axilent.  All of the clients of a connection share its pooled
+    transport, and the clients for each app and resource are built once.
     """
-    def __init__(self,apikey,api_version='astoria',endpoint='https://www.axilent.net'):
+    def __init__(self,apikey,api_version='astoria',endpoint='https://www.axilent.net',max_connections=10):
         self.apikey = apikey
         self.version = api_version
         self.endpoint = endpoint
-    
+        self.transport = PooledTransport(max_connections=max_connections)
+        self.clients = {}
+        self.lock = threading.Lock()
+
     def http_client(self,app):
         """
         Gets an HTTP client for the specified app.
         """
-        return HttpClient('%s/api' % self.endpoint,app,self.version,auth_user=self.apikey)
-    
+        with self.lock:
+            if not (app,None) in self.clients:
+                self.clients[(app,None)] = PooledHttpClient(self.transport,'%s/api' % self.endpoint,app,self.version,auth_user=self.apikey)
+            return self.clients[(app,None)]
+
     def resource_client(self,app,resource):
         """
         Gets a resource client for the specified app.
         """
-        return ResourceClient('%s/api/resource' % self.endpoint,app,self.version,resource,auth_user=self.apikey)
+        with self.lock:
+            if not (app,resource) in self.clients:
+                self.clients[(app,resource)] = PooledResourceClient(self.transport,'%s/api/resource' % self.endpoint,app,self.version,resource,auth_user=self.apikey)
+            return self.clients[(app,resource)]
+
+    def stats(self):
+        """
+        Gets the connection pool statistics.
+        """
+        return self.transport.stats()
@@ -0,0 +1,92 @@
+"""
+Concurrent variants of the Pax clients.  Each method mirrors the method of the same
+name on the blocking client, but runs the call on a shared thread pool and returns
+an AsyncResult at once.  Use gather to wait for several calls:
+
+    content = AsyncContentClient(cx)
+    featured, results = gather(content.channel('featured'),content.search('jazz','Article'))
+"""
+from multiprocessing.pool import ThreadPool
+from pax.content import ContentClient
+from pax.triggers import TriggerClient
+from pax.library import LibraryClient
+from pax.calendar import CalendarClient
+from pax.messaging import MessagingClient
+import os
+import threading
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+pool_size = 10
+
+def get_pool():
+    """
+    Gets the shared thread pool, creating it if this process does not have one yet.
+    """
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPool(pool_size)
+                _pool_pid = os.getpid()
+    return _pool
+
+def gather(*results,**kwargs):
+    """
+    Waits for the results of several concurrent calls, returning a list of their
+    values in order.  Raises the exception of the first failed call.  Accepts an
+    optional timeout in seconds for each call.
+    """
+    timeout = kwargs.get('timeout',None)
+    return [result.get(timeout) for result in results]
+
+class AsyncClient(object):
+    """
+    Base class for concurrent clients.  Wraps an instance of client_class.
+    """
+    client_class = None
+
+    def __init__(self,axilent_connection,pool=None):
+        self.client = self.client_class(axilent_connection)
+        self.pool = pool
+
+    def __getattr__(self,name):
+        method = getattr(self.client,name)
+        if not callable(method):
+            return method
+
+        def call(*args,**kwargs):
+            return (self.pool or get_pool()).apply_async(method,args,kwargs)
+        return call
+
+class AsyncContentClient(AsyncClient):
+    """
+    Concurrent content client.
+    """
+    client_class = ContentClient
+
+class AsyncTriggerClient(AsyncClient):
+    """
+    Concurrent triggers client.
+    """
+    client_class = TriggerClient
+
+class AsyncLibraryClient(AsyncClient):
+    """
+    Concurrent library client.
+    """
+    client_class = LibraryClient
+
+class AsyncCalendarClient(AsyncClient):
+    """
+    Concurrent calendar client.
+    """
+    client_class = CalendarClient
+
+class AsyncMessagingClient(AsyncClient):
+    """
+    Concurrent messaging client.
+    """
+    client_class = MessagingClient
@@ -162,6 +162,25 @@ class ContentClient(object):
         """
         return self.api.getcontentkeys(content_type_slug=slugify(content_type))
 
+    def changed_content_keys(self,content_type,since=None,cursor=None):
+        """
+        Gets the keys of content of the specified type changed since a date, or since
+        a cursor returned by an earlier call.  Returns a 2-tuple of the list of keys and
+        the cursor to pass to the next call.
+        """
+        response = self.api.changedcontentkeys(content_type_slug=slugify(content_type),
+                                               since=since.isoformat() if since else None,
+                                               cursor=cursor)
+        return (response['keys'],response.get('cursor'))
+
+    def get_content_batch(self,content_type,keys):
+        """
+        Gets several content items of the same type in a single call.  Returns a list
+        of ContentImages, one for each key found.
+        """
+        response = self.api.getcontentbatch(content_type_slug=slugify(content_type),content_keys=','.join(keys))
+        return [ContentImage(data) for data in response]
+
     def get_content_by_unique_field(self,content_type,field_name,field_value):
         """
         Gets a content item matching the specified field value.
@@ -175,3 +194,11 @@ class ContentClient(object):
         """
         response = self.api.latestupdate(content_type_slug=slugify(content_type),content_key=content_key)
         return parser.parse(response['updated']) if response['updated'] else None
+
+    def latest_updates(self,content_type,content_keys):
+        """
+        Gets the dates of the latest updates for several content items of the same type.
+        Returns a dictionary of content key to update date (or None).
+        """
+        response = self.api.latestupdates(content_type_slug=slugify(content_type),content_keys=','.join(content_keys))
+        return dict((key,parser.parse(updated) if updated else None) for key, updated in response['updated'].items())
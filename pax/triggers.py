@@ -25,6 +25,13 @@ class TriggerClient(object):
                                'identity':identity},
                                local_param_check=False)
 
+    def trigger_batch(self,triggers):
+        """
+        Sends several triggers to Axilent in a single call.  Each trigger is a dictionary
+        with the category, action, profile, variables, environment and identity keys.
+        """
+        self.api.triggerbatch(data={'triggers':triggers},
+                              local_param_check=False)
 
     def profile(self):
         """